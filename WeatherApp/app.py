@@ -1,87 +1,369 @@
 import os
+import io
 import csv
+import hashlib
+import json
 import logging
-import pandas as pd
+import time
 
-from re import match
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session, send_from_directory, url_for
-from flask_session import Session
+from itertools import islice
+
+from flask import Blueprint, Flask, Response, before_render_template, current_app, flash, g, jsonify, redirect, render_template, request, session, send_from_directory, stream_with_context, template_rendered, url_for
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
+from jinja2 import FileSystemBytecodeCache
+
+from broker import ReadingBroker, Subscription
+from bulkweather import BulkWeather
+from citysearch import search_cities
+from config import PROFILES
+from database import Database
+from helpers import apology, login_required, lookup_geo, lookup_geo_many, cached_weather, init_geo_cache, init_upstream, init_weather_cache, init_weather_history, weather_cache_key
+from importer import import_rows
+from jobs import ImportJobs
+from metrics import Metrics, SlowRequestProfiler
+from migrations import migrate
+from ratelimit import CircuitBreaker, SharedTokenBucket
+from refresher import WeatherRefresher
+from sessions import SQLiteSessionInterface
+
+# Views and hooks, registered on the app by create_app
+bp = Blueprint("weather", __name__, cli_group=None)
+
+# Services used by the views, set up by create_app (module globals like the caches in helpers, so one app per process)
+metrics = None
+profiler = None
+db = None
+import_jobs = None
+weather_cache = None
+weather_history = None
+geo_cache = None
+upstream = None
+bulk_weather = None
+refresher = None
+broker = None
+
+
+def create_app(profile=None):
+    """
+    Flask app with the settings of profile (development or production, default APP_PROFILE), its session store,
+    services and views. Importing this module opens nothing; flask run, gunicorn "app:create_app()" and asgi.py call this.
+    Upload imports run in the web workers (IMPORT_IN_WEB, the development default) or in `flask --app app import-worker`.
+    """
+    global metrics, profiler, db, import_jobs, weather_cache, weather_history, geo_cache, upstream, bulk_weather, refresher, broker
+
+    profile = profile or os.environ.get("APP_PROFILE", "development")
+    if profile not in PROFILES:
+        raise RuntimeError(f"unknown APP_PROFILE {profile}, expected one of {', '.join(PROFILES)}")
+
+    # Make sure API key is set
+    if not os.environ.get("API_KEY"):
+        raise RuntimeError("API_KEY not set")
+
+    # Configure application
+    app = Flask(__name__)
+    app.config.from_object(PROFILES[profile])
+
+    #compiled templates survive restarts, so a new worker doesn't compile them again
+    if app.config['JINJA_CACHE_FOLDER']:
+        os.makedirs(app.config['JINJA_CACHE_FOLDER'], exist_ok=True)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(app.config['JINJA_CACHE_FOLDER']))
+
+    if app.config["SESSION_TYPE"] == "sqlite":
+        app.session_interface = SQLiteSessionInterface(app.config["SESSION_SQLITE_PATH"], app.config["SESSION_SWEEP_INTERVAL"])
+    else:
+        #Flask-Session is only imported when it is used
+        from flask_session import Session
+        Session(app)
+
+    # Metrics shared by all workers
+    metrics = Metrics(app.config['METRICS_PATH'], app.config['METRICS_FLUSH_INTERVAL'], retire_after=app.config['METRICS_RETIRE_AFTER'])
+    metrics.describe("http_request_duration_seconds", "histogram", "Time to respond by route, method and status.")
+    metrics.describe("template_render_duration_seconds", "histogram", "Jinja rendering time by template.")
+    metrics.describe("password_check_duration_seconds", "histogram", "Time spent checking password hashes at login.")
+    metrics.describe("import_rows_total", "counter", "Upload rows imported by outcome (success, warn, fail).")
+    metrics.describe("import_seconds_total", "counter", "Time spent running import jobs, rows/sec is import_rows_total over this.")
+    profiler = SlowRequestProfiler(threshold=app.config['PROFILE_THRESHOLD'], keep=app.config['PROFILE_KEEP'])
+
+    # Pooled SQLite data layer
+    db = Database(app.config['DATABASE'], app.config['DB_POOL_SIZE'], cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+                  mmap_size_mb=app.config['DB_MMAP_SIZE_MB'], metrics=metrics)
+
+    # Bring the schema up to date (indexes, constraints), see migrations.py
+    migrate(app.config['DATABASE'])
+
+    # Background import jobs for uploads, run in an app context so process() can read the config
+    def run_import(job):
+        with app.app_context():
+            return process(job)
+
+    import_jobs = ImportJobs(app.config['DATABASE'], app.config['UPLOAD_FOLDER'], run_import,
+                             app.config['IMPORT_WORKERS'], app.config['IMPORT_STALE_AFTER'], app.config['IMPORT_KEEP_DAYS'])
+
+    # Weather cache shared by all workers
+    weather_cache = init_weather_cache(app.config['WEATHER_CACHE_PATH'], app.config['WEATHER_CACHE_TTL'], app.config['WEATHER_CACHE_SIZE'],
+                                       app.config['WEATHER_GRID'])
+
+    # Reading history
+    weather_history = init_weather_history(app.config['HISTORY_PATH'], lambda lat, lon: cities_at(lat, lon, app.config['WEATHER_GRID']),
+                                           app.config['HISTORY_RAW_HOURS'] * 3600, app.config['HISTORY_HOURLY_DAYS'] * 86400,
+                                           app.config['HISTORY_DAILY_DAYS'] * 86400)
+
+    # Geocode cache, in the same file as the weather cache
+    geo_cache = init_geo_cache(app.config['WEATHER_CACHE_PATH'], app.config['GEO_CACHE_TTL'], app.config['GEO_CACHE_NEGATIVE_TTL'],
+                               app.config['GEO_CACHE_SIZE'])
+
+    #limiter and breaker state live in the cache file so every worker sees the same budget and breaker
+    limiter = SharedTokenBucket(app.config['WEATHER_CACHE_PATH'], "openweathermap", app.config['UPSTREAM_RPM'], app.config['UPSTREAM_BURST'])
+    breaker = CircuitBreaker(app.config['WEATHER_CACHE_PATH'], "openweathermap", app.config['BREAKER_THRESHOLD'],
+                             app.config['BREAKER_MIN_CALLS'], app.config['BREAKER_WINDOW'], app.config['BREAKER_COOLDOWN'])
+    upstream = init_upstream(app.config['UPSTREAM_POOL_SIZE'], app.config['UPSTREAM_CONNECT_TIMEOUT'], app.config['UPSTREAM_READ_TIMEOUT'],
+                             app.config['UPSTREAM_RETRIES'], app.config['UPSTREAM_BACKOFF'], limiter, breaker, app.config['UPSTREAM_LIMIT_WAIT'],
+                             app.config['UPSTREAM_BASE_URL'], metrics)
+
+    # Background weather refresher
+    bulk_weather = BulkWeather(app.config['WEATHER_BOX_SIZE'], app.config['WEATHER_BOX_MIN_CELLS'], app.config['WEATHER_BOX_MATCH'],
+                               app.config['WEATHER_BOX_ZOOM'], app.config['WEATHER_MAX_WORKERS'], app.config['WEATHER_DEADLINE'])
+    refresher = WeatherRefresher(dashboard_cities, bulk_weather, app.config['WEATHER_REFRESH_HOT'], app.config['WEATHER_REFRESH_COLD'],
+                                 app.config['WEATHER_HOT_SUBSCRIBERS'], app.config['WEATHER_REFRESH_BATCH'])
+
+    # Live dashboard streams
+    broker = ReadingBroker(weather_cache, app.config['STREAM_POLL_INTERVAL'])
+
+    #time template rendering
+    before_render_template.connect(start_template_timer, app)
+    template_rendered.connect(observe_template, app)
+
+    app.register_blueprint(bp)
+    return app
+
+
+def cities_at(lat, lon, grid):
+    """Ids of the cities a reading for these (cache key) coordinates belongs to, i.e. every city in its grid cell."""
+    reach = grid / 2 + 0.0001
+    rows = db.execute("""SELECT cities.city_id, lat, lon FROM cities_rtree JOIN cities ON cities.city_id = cities_rtree.city_id
+                         WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?""",
+                      lat - reach, lat + reach, lon - reach, lon + reach)
+    #the box also catches cities just across the cell's edges
+    return [row["city_id"] for row in rows if weather_cache_key(row["lat"], row["lon"])[:2] == [lat, lon]]
+
+
+def dashboard_cities():
+    """Every distinct city on any dashboard, with how many dashboards it is on."""
+    return db.execute("SELECT cities.city_id, city_name, lat, lon, COUNT(*) AS subscribers FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id GROUP BY cities.city_id")
 
-from helpers import apology, login_required, lookup_geo, lookup_weather
 
-# Configure application
-app = Flask(__name__)
+@bp.before_app_request
+def start_background_threads():
+    """Make sure this worker's refresher, import job and broker threads are running (threads don't survive a fork)"""
+    refresher.start()
+    if current_app.config['IMPORT_IN_WEB']:
+        import_jobs.start()
+    broker.start()
+    metrics.start()
+    if current_app.config['PROFILE_SLOW_REQUESTS']:
+        profiler.start()
 
-# Ensure templates are auto-reloaded
-app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+@bp.cli.command("import-worker")
+def import_worker():
+    """Run upload import jobs in this process, for setups where web workers don't (IMPORT_IN_WEB off)"""
+    metrics.start()
+    import_jobs.serve()
 
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///weather.db")
 
-# Make sure API key is set
-if not os.environ.get("API_KEY"):
-    raise RuntimeError("API_KEY not set")
+@bp.before_app_request
+def start_request_timer():
+    """Note when the request started, for the latency histogram and the slow request profiler"""
+    g.request_started = time.perf_counter()
+    if current_app.config['PROFILE_SLOW_REQUESTS']:
+        profiler.begin(f"{request.method} {request.full_path.rstrip('?')}")
 
-# Configure upload directory
-app.config['UPLOAD_FOLDER'] = 'uploads/'
 
-# Configure max file upload size
-max_MB = 16
-app.config['MAX_CONTENT_LENGTH'] = max_MB * (1024 * 1024)
+@bp.teardown_app_request
+def stop_profiling(exc):
+    if current_app.config['PROFILE_SLOW_REQUESTS']:
+        profiler.end()
 
-# configure allowable file extensions
-app.config['ALLOWED_EXTENSIONS'] = ['.csv']
 
-# configure log directory and file
-app.config['LOG_FOLDER'] = 'logfolder'
-app.config['LOG_FILE'] = 'log.txt'
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault("template_started", []).append(time.perf_counter())
 
-# configure template directory and file and columns
-app.config['TEMPLATE_FOLDER'] = 'uploadtemplate'
-app.config['TEMPLATE_FILE'] = 'uploadtemplate.csv'
-app.config['TEMPLATE_COLUMNS'] = ['city_name', 'state_code', 'country_code', 'lat', 'lon', 'country (2 letter)']
 
+def observe_template(sender, template, context, **extra):
+    started = g.get("template_started")
+    if started:
+        metrics.observe("template_render_duration_seconds", time.perf_counter() - started.pop(), {"template": template.name})
 
-@app.after_request
+
+# static file fingerprints, {filename: (mtime, digest)}
+static_fingerprints = {}
+
+
+@bp.app_url_defaults
+def static_fingerprint(endpoint, values):
+    """Add a content hash to static urls (?v=...), so a changed file gets a new url and old ones can be cached for good"""
+    if endpoint != "static" or "filename" not in values:
+        return
+
+    path = os.path.join(current_app.static_folder, values["filename"])
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+
+    cached = static_fingerprints.get(values["filename"])
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            cached = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+        static_fingerprints[values["filename"]] = cached
+    values["v"] = cached[1]
+
+
+@bp.after_app_request
 def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
+    """Cache fingerprinted static files for a year, never store pages rendered for a logged in user, time the request"""
+    if "request_started" in g:
+        #unmatched urls share one label so scanners can't blow up the number of series
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_started,
+                        {"route": route, "method": request.method, "status": str(response.status_code)})
+
+    if request.endpoint == "static" and request.args.get("v"):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    elif response.mimetype == "text/html" and session.get("user_id") is not None:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
     return response
 
 
-@app.route("/")
+def dashboard_weather(userid):
+    """Cards for the user's dashboard from the last known readings, queuing a refresh for anything stale or missing"""
+    dash_data = db.execute("SELECT * FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id WHERE user_id = ?", userid)
+
+    city_list, stale_rows = cached_weather(dash_data)
+    refresher.request_refresh(stale_rows)
+    return city_list
+
+
+def dashboard_etag(city_list):
+    """Strong ETag from each card's city and reading version (when it was stored), so it only changes with the data"""
+    versions = [(card["city_id"], card.get("updated_at")) for card in city_list]
+    return hashlib.sha256(json.dumps(versions).encode()).hexdigest()[:32]
+
+
+@bp.route("/")
 @login_required
 def index():
 
-    #get user_id
-    userid = session["user_id"]
+    #serve last known readings straight from the cache and let the refresher fetch anything stale or missing
+    city_list = dashboard_weather(session["user_id"])
 
-    #fetch user dash data
-    dash_data = db.execute("SELECT * FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id WHERE user_id = ?", userid)
+    return render_template("index.html", city_list=city_list)
 
-    #create list to store lists/dicts
-    city_list = []
 
-    #make api call and add output to city_list for each city in user dashboard
-    for row in dash_data:
-        weather_data = lookup_weather(row["lat"], row["lon"], row["city_name"], row["city_id"])
-        city_list.append(weather_data)
+@bp.route("/api/dashboard")
+@login_required
+def api_dashboard():
 
-    return render_template("index.html", city_list=city_list)
+    city_list = dashboard_weather(session["user_id"])
+
+    #nothing changed since the client's copy, skip building the body
+    etag = dashboard_etag(city_list)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        #ages change every second, clients get the stored time instead so the body only changes with the data
+        response = jsonify({"cities": [{key: value for key, value in card.items() if key != "age"} for card in city_list]})
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@bp.route("/api/dashboard/stream")
+@login_required
+def dashboard_stream():
+
+    stream = DashboardStream(session["user_id"], request.args.get("since", 0, type=float))
+    stream.subscribe()
+    heartbeat = current_app.config['STREAM_HEARTBEAT']
+
+    def events():
+        try:
+            yield from stream.opening()
+            while True:
+                yield from stream.events(stream.subscription.wait(heartbeat))
+        finally:
+            stream.close()
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@bp.route("/api/dashboard/history")
+@login_required
+def dashboard_history():
+
+    #trend for every city on the user's dashboard over the last ?hours= hours (at most the daily retention)
+    hours = max(1, min(request.args.get("hours", 24, type=int), current_app.config['HISTORY_DAILY_DAYS'] * 24))
+    rows = db.execute("SELECT city_id FROM dashboard WHERE user_id = ?", session["user_id"])
+    series = weather_history.series([row["city_id"] for row in rows], time.time() - hours * 3600)
+
+    return jsonify({"hours": hours, "cities": {str(city_id): columns for city_id, columns in series.items()}})
+
+
+class DashboardStream:
+    """
+    Events of one open /api/dashboard/stream, for the Flask route (a thread per stream) and asgi.py (a coroutine per stream).
+
+    Creating it loads the user's dashboard (database and cache reads, so a coroutine does it on a worker thread); the server then
+    subscribes, sends opening(), and sends events() for every wait on the subscription until the client goes, then calls close().
+    """
+
+    def __init__(self, userid, since):
+        dash_data = db.execute("SELECT * FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id WHERE user_id = ?", userid)
+
+        #cards are matched to cache entries by the reading's cache key
+        self.rows_by_key = {}
+        for row in dash_data:
+            self.rows_by_key.setdefault(weather_cache.make_key(weather_cache_key(row["lat"], row["lon"])), []).append(row)
+
+        city_list, stale_rows = cached_weather(dash_data)
+        refresher.request_refresh(stale_rows)
+        #readings stored after the client's copy are sent straight away
+        self.missed = [card for card in city_list if card.get("updated_at", 0) > since]
+        self.subscription = None
+
+    def subscribe(self, subscription_class=Subscription):
+        self.subscription = broker.subscribe(self.rows_by_key, subscription_class)
+
+    def opening(self):
+        """Reconnect delay for the browser, then the readings the client missed"""
+        yield "retry: 5000\n\n"
+        for card in self.missed:
+            yield self.event(card)
+
+    def events(self, updates):
+        """Events for one wait on the subscription: a keep-alive on timeout, else one per dashboard city a reading belongs to"""
+        if not updates:
+            yield ": keep-alive\n\n"
+        for key, (reading, stored_at) in updates.items():
+            for row in self.rows_by_key[key]:
+                yield self.event(dict(reading, city=row["city_name"], city_id=row["city_id"], updated_at=stored_at))
+
+    def close(self):
+        broker.unsubscribe(self.subscription)
 
+    @staticmethod
+    def event(card):
+        """One server-sent event carrying a city's reading"""
+        return f"event: reading\ndata: {json.dumps(card)}\n\n"
 
-@app.route("/login", methods=["GET", "POST"])
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
 
     # Forget any user_id
@@ -102,7 +384,11 @@ def login():
         rows = db.execute("SELECT * FROM users WHERE username = ?", request.form.get("username"))
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        if len(rows) != 1:
+            return apology("invalid username and/or password", 403)
+        with metrics.span("password_check_duration_seconds"):
+            valid = check_password_hash(rows[0]["hash"], request.form.get("password"))
+        if not valid:
             return apology("invalid username and/or password", 403)
 
         # Remember which user has logged in
@@ -119,7 +405,7 @@ def login():
         return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
 
     # Forget any user_id
@@ -129,7 +415,7 @@ def logout():
     return redirect("/login")
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     # User reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
@@ -166,7 +452,7 @@ def register():
         return render_template("register.html")
 
 
-@app.route("/account", methods=["GET", "POST"])
+@bp.route("/account", methods=["GET", "POST"])
 @login_required
 def account():
     #if page is reached via POST
@@ -213,7 +499,7 @@ def account():
     return render_template("account.html")
 
 
-@app.route("/addcitydash", methods=["GET", "POST"])
+@bp.route("/addcitydash", methods=["GET", "POST"])
 @login_required
 def addcitydash():
 
@@ -222,31 +508,35 @@ def addcitydash():
         userid = session["user_id"]
         cityid = request.form.get("city")
 
-        #check if the selected city is already on users dashboard
-        rows = db.execute("SELECT * FROM dashboard where user_id = ? AND city_id = ?", userid, cityid)
-
-        #if city is not on dashboard, add it
-        if len(rows) == 0:
-            db.execute("INSERT INTO dashboard (user_id, city_id) VALUES (?,?)", userid, cityid)
-            cityname = db.execute("SELECT * FROM cities where city_id = ?", cityid)
-            cityname = cityname[0]["city_name"].title()
-            flash(f"{cityname} added to dashboard!")
+        #add the city unless it is already on the users dashboard (unique user_id, city_id)
+        added = db.execute("INSERT OR IGNORE INTO dashboard (user_id, city_id) VALUES (?,?)", userid, cityid)
 
         #if city is on dashboard, show apology
-        if len(rows) != 0:
+        if added is None:
             return apology("this city is already on your dashboard!", 403)
 
-        #get db data for dropdown
-        citylist = db.execute("SELECT * FROM cities order by city_name")
+        cityname = db.execute("SELECT * FROM cities where city_id = ?", cityid)
+        refresher.request_refresh(cityname)
+        cityname = cityname[0]["city_name"].title()
+        flash(f"{cityname} added to dashboard!")
 
         return redirect("/")
 
-    #get db info for dropdown
-    citylist = db.execute("SELECT * FROM cities order by city_name")
+    #the city picker loads its options from /cities/search
+    return render_template("addcitydash.html")
 
-    return render_template("addcitydash.html", citylist=citylist)
 
-@app.route("/addcitydb", methods=["GET", "POST"])
+@bp.route("/cities/search")
+@login_required
+def city_search():
+
+    #one page of matching cities, the next page starts after next_after
+    cities, next_after = search_cities(db, request.args.get("q", ""), request.args.get("after"),
+                                       request.args.get("limit", 20, type=int))
+
+    return jsonify({"cities": cities, "next_after": next_after})
+
+@bp.route("/addcitydb", methods=["GET", "POST"])
 @login_required
 def addcitydb():
 
@@ -271,27 +561,26 @@ def addcitydb():
         else:
             statecode = request.form.get("statecode")
 
-        #make API to to geocoder API
-        geo_data = lookup_geo(cityname, statecode, countrycode)
+        #known cities are rejected before any geocoder call
+        rows = db.execute("SELECT * FROM cities WHERE city_name = ? AND country_code = ?", cityname, countrycode)
+        if len(rows) != 0:
+            return apology("city already exists in database", 403)
 
-        if geo_data != None:
-            rows = db.execute("SELECT * FROM cities WHERE city_name = ? AND country_code = ?", cityname, countrycode)
-        else:
+        #make API to to geocoder API (answered from the geocode cache when possible)
+        geo_data = lookup_geo(cityname, statecode, countrycode)
+        if geo_data == None:
             return apology("api call failed, please try correcting city name and country code", 403)
 
-        if len(rows) == 0:
-            db.execute("INSERT INTO cities (city_name, state_code, country_code, lat, lon, country) VALUES (?, ?, ?, ?, ?, ?)", cityname, statecode, countrycode, geo_data["lat"], geo_data["lon"], geo_data["country"])
-            flash(f'{cityname} has been added to the database!')
-
-        if len(rows) != 0:
-            return apology("city already exists in database", 403)
+        db.execute("INSERT INTO cities (city_name, state_code, country_code, lat, lon, country) VALUES (?, ?, ?, ?, ?, ?)", cityname, statecode, countrycode, geo_data["lat"], geo_data["lon"], geo_data["country"])
+        flash(f'{cityname} has been added to the database!')
 
         return render_template("addcitydb.html")
 
     else:
-        return render_template("addcitydb.html")
+        #show progress for an upload job that was just queued
+        return render_template("addcitydb.html", job=request.args.get("job"))
 
-@app.route("/remove", methods=["GET", "POST"])
+@bp.route("/remove", methods=["GET", "POST"])
 @login_required
 def remove():
     #reached via POST
@@ -314,7 +603,7 @@ def remove():
     #reached via GET (no href this shouldnt happen)
     return redirect("/")
 
-@app.route("/deleteaccount", methods=["GET", "POST"])
+@bp.route("/deleteaccount", methods=["GET", "POST"])
 @login_required
 def deleteaccount():
 
@@ -329,7 +618,7 @@ def deleteaccount():
         #if answer is yes, clear session and delete user data from DB
         if answer == "yes":
             session.clear()
-            db.execute("DELETE FROM dashboard WHERE user_id = ?", userid)
+            #dashboard rows go with the user (ON DELETE CASCADE)
             db.execute("DELETE FROM users WHERE id = ?", userid)
 
         #return to login
@@ -338,7 +627,7 @@ def deleteaccount():
     #reached via GET, shouldnt happen as there is no href
     return redirect("/")
 
-@app.route("/fileupload", methods=["POST"])
+@bp.route("/fileupload", methods=["POST"])
 @login_required
 def upload():
 
@@ -349,12 +638,9 @@ def upload():
 
         # if there is a file, check extension is allowed (make sure it is a .csv)
         if file:
-            if extension not in app.config['ALLOWED_EXTENSIONS']:
+            if extension not in current_app.config['ALLOWED_EXTENSIONS']:
                 return apology("File extension not allowed! Please upload .csv files only!")
 
-        # save file for later reference
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename)))
-
         # if there is no file selected when upload is clicked, flash message letting user know to select a csv file for upload
         if not file:
             flash("No file selected! Please select a .csv file for upload.")
@@ -364,199 +650,205 @@ def upload():
     except RequestEntityTooLarge:
         return apology("File size is larger than the max 16MB!")
 
-    # call the process function to read csv into database
-    success, warn, fail = process()
-
-    #flash messages
-    #no data
-    if success == 0 and warn == 0 and fail == 0:
-        flash("Upload failed. No data in file. Please resubmit file containing data.")
-
-    #not using template
-    elif success == -1 and warn == -1 and fail == -1:
+    #reject files that don't use the template right away, the header is read straight from the request stream
+    if read_header(file.stream) != current_app.config['TEMPLATE_COLUMNS']:
         flash("Please use only the template file for uploads. Please do not alter the column titles.")
+        return redirect('/addcitydb')
+    file.stream.seek(0)
 
-    #default output
-    else:
-        flash(f"File uploaded with {success} successful row(s), {fail} failed row(s), and {warn} warning(s). Please review log file for more detailed information.")
-
-    #delete upload file from directory after processing
-    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename)))
-
-    return redirect('/addcitydb')
-
-def process():
-    #get file from uploads folder
-    files = os.listdir(app.config['UPLOAD_FOLDER'])
-    file = os.path.join(app.config['UPLOAD_FOLDER'], files[0])
+    #queue the upload as a background job, the page polls its progress
+    job_id = import_jobs.create(session["user_id"], secure_filename(file.filename), file.stream)
+    flash(f"File accepted for processing (job {job_id}). Progress is shown below.")
 
-    #open and read file to a list of dicts
-    with open(file, "r") as f:
-        reader = csv.DictReader(f)
-        data = list(reader)
-
-    #validate template file and return negative values for success, warn, fail if not template
-    try:
-        df = pd.read_csv(file)
-        list_of_column_names = list(df.columns)
-        print(list_of_column_names)
-
-    except:
-        return -1, -1, -1
-
-    if list_of_column_names != app.config['TEMPLATE_COLUMNS']:
-        return -1, -1, -1
-
-
-    #set counters for successful insert, warning, failure for message flash
-    total_row_errors = 0
-    total_row_success = 0
-    total_row_warn = 0
-
-    #set line variable to excel row where data starts for error logging through upload file
-    line = 1
-
-    #set lat/lon increment range
-    lat_lon_range = 0.5
-
-    # configure handler and start logger
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-
-    logging.basicConfig(filename="logfolder/log.txt", level=logging.DEBUG,
-                        format="%(asctime)s %(levelname)-8s %(message)s", filemode="w")
-
-    #start log
-    logging.debug(f"Attempting DB upload for {file}")
-
-
-    for row in data:
-        line += 1
-        row_errors = 0
-        #log current line in excel file
-        logging.info(f"Processing line {line} of upload file")
-
-        #implement logic checks
-        if match("^[a-zA-z]+\s?[a-zA-Z]+\s?[a-zA-Z]+\s?$", row["city_name"]) == None:
-            row_errors += 1
-            logging.error("City name is not alphabetic or was not entered. Please update city name to only alphabetic characters.")
+    return redirect(url_for('.addcitydb', job=job_id))
 
-        if row["state_code"]:
-            state_code = row["state_code"]
-            if not state_code.isnumeric():
-                row_errors += 1
-                logging.error("State code is not numeric. Please update state code to only numeric characters")
 
-        if row["state_code"] == "":
-            state_code = None
-
-        if not row["country_code"].isnumeric():
-            row_errors += 1
-            logging.error("Country code is not numeric or was not entered. Please update country code to only numeric characters")
+@bp.route("/fileupload/<job_id>")
+@login_required
+def upload_status(job_id):
+
+    #only the user who uploaded the file can see its job
+    job = import_jobs.get(job_id)
+    if job is None or job["user_id"] != session["user_id"]:
+        return jsonify({"error": "job not found"}), 404
+
+    return jsonify({
+        "job_id": job["job_id"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "rows_done": job["rows_done"],
+        "success": job["success"],
+        "warn": job["warn"],
+        "fail": job["fail"],
+        "elapsed": job.get("elapsed"),
+        "rows_per_sec": job.get("rows_per_sec"),
+        "message": job_message(job)
+    })
+
+
+def job_message(job):
+    #no data
+    if job["status"] == "done" and job["success"] == 0 and job["warn"] == 0 and job["fail"] == 0:
+        return "Upload failed. No data in file. Please resubmit file containing data."
 
-        if match("^-?(0|[1-9]\d*)(\.\d+)?$", row["lat"]) == None:
-            row_errors += 1
-            logging.error(f"Lat \'{row['lat']}\' is not numeric or was not entered. Please update lat to only numeric characters with the exception of '-' and '.'")
+    #default output
+    if job["status"] == "done":
+        return f"File uploaded with {job['success']} successful row(s), {job['fail']} failed row(s), and {job['warn']} warning(s). Please review log file for more detailed information."
 
-        if match("^-?(0|[1-9]\d*)(\.\d+)?$", row["lon"]) == None:
-            row_errors += 1
-            logging.error(f"Lon \'{row['lon']}\' is not numeric or was not entered. Please update lon to only numeric characters with the exception of '-' and '.'")
+    if job["status"] == "failed":
+        return "Upload failed while processing. Please review log file for more detailed information."
 
-        if not row["country (2 letter)"].isalpha():
-            row_errors += 1
-            logging.error("Country is not alphabetic or was not entered. Please update country to only alphabetic characters")
+    #queued or running
+    return f"Processing... {job['rows_done']} row(s) done: {job['success']} successful, {job['fail']} failed, {job['warn']} warning(s)."
 
-        if len(row["country (2 letter)"]) != 2:
-            row_errors += 1
-            logging.error("Country is not 2 letters in length or was not entered. Please update country to its 2 letter abbreviation")
 
+def read_header(stream):
+    """Column names from the first line of an uploaded binary stream, or None if it isn't readable csv."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        return next(csv.reader(text), None)
+    except (UnicodeDecodeError, csv.Error):
+        return None
+    finally:
+        #hand the stream back without closing it
+        text.detach()
 
 
-        #log errors if any
-        if row_errors == 0:
-            warn = 0
-            #check if city or town exists in db
-            #checks lat/lon input in case a town or city has the same name in the country ----- ?+0.5 0.5 is meant to represent a roughly 30 mile difference
-            check_row = db.execute("SELECT * FROM cities WHERE city_name = ? AND country_code = ? AND country = ? AND lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?",
-                                    row["city_name"].title(), row["country_code"], row["country (2 letter)"].upper(),
-                                    float(row["lat"])-lat_lon_range, float(row["lat"])+lat_lon_range, float(row["lon"])-lat_lon_range, float(row["lon"])+lat_lon_range)
+def process(job):
+    started = time.perf_counter()
 
-            #if already exists in db log warning and don't submit to db
-            if len(check_row) != 0:
-                cityname = row["city_name"].title()
-                country = row["country (2 letter)"].upper()
-                logging.warning(f"{cityname}, {country} already exists in the database! This line will not submit to database.")
-                warn += 1
-                total_row_warn += 1
+    def on_chunk(conn, rows, success, warn, fail, records):
+        import_jobs.progress(conn, job, rows, success, warn, fail, records)
+        for outcome, count in (("success", success), ("warn", warn), ("fail", fail)):
+            metrics.inc("import_rows_total", {"outcome": outcome}, count)
 
-            #if does not exist in db, submit and log
-            if len(check_row) == 0:
-                cityname = row["city_name"].title()
-                country = row["country (2 letter)"].upper()
+    #read the spooled upload for this job only
+    with open(job["path"], "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
 
-                db.execute("INSERT INTO cities (city_name, state_code, country_code, lat, lon, country) VALUES (?, ?, ?, ?, ?, ?)",
-                            cityname, state_code, row["country_code"], row["lat"], row["lon"], row["country (2 letter)"].upper())
-                logging.info(f"{cityname}, {country} entered into DB successfully")
+        #rows already committed by an earlier run of this job (before a restart) are skipped
+        done = job["rows_done"]
+        rows = islice(read_rows(reader, job["job_id"]), done, None)
 
-                total_row_success += 1
+        #start log, each job has its own log in the import_log table
+        import_jobs.log_now(job["job_id"], [(None, logging.DEBUG, f"Attempting DB upload for {job['filename']}")])
 
-            #logging for no errors or warnings. logging for warnings
-            if warn == 0:
-                logging.info(f"No errors or warnings found in line {line}")
-            else:
-                logging.info(f"{warn} warning found in line {line}")
+        #rows are parsed lazily and validated, de-duplicated and inserted a chunk at a time, progress and log lines are committed with each chunk
+        total_row_success, total_row_warn, total_row_errors = import_rows(
+            current_app.config['DATABASE'], rows, current_app.config['IMPORT_CHUNK_SIZE'], start_line=1 + done,
+            on_chunk=on_chunk, geocode=lambda places: lookup_geo_many(places, current_app.config['IMPORT_GEO_WORKERS']))
+    metrics.inc("import_seconds_total", amount=time.perf_counter() - started)
 
-        #logging for errors
-        if row_errors != 0:
-            logging.warning(f"{row_errors} error(s) found in line {line}")
+    #log and return error counters
+    if done == 0 and total_row_success == 0 and total_row_warn == 0 and total_row_errors == 0:
+        import_jobs.log_now(job["job_id"], [(None, logging.ERROR, "No data in upload file")])
 
-        #update total row errors for flash message after upload,
-        if row_errors > 0:
-            total_row_errors += 1
+    return total_row_success, total_row_warn, total_row_errors
 
-    #stop logging and return error counters
-    if total_row_success == 0 and total_row_warn == 0 and total_row_errors == 0:
-        logging.error("No data in upload file")
 
-    logging.shutdown()
-    return total_row_success, total_row_warn, total_row_errors
+def read_rows(reader, job_id):
+    """Yield upload rows, stopping (with a log line) if the file turns out not to be readable text/csv part way through."""
+    try:
+        yield from reader
+    except (UnicodeDecodeError, csv.Error) as e:
+        import_jobs.log_now(job_id, [(reader.line_num, logging.ERROR, f"Stopped reading upload file at line {reader.line_num}: {e}")])
 
 
 
 
 # download log file from upload
-@app.route('/downloadlogs', methods=["GET", "POST"])
+@bp.route('/downloadlogs', methods=["GET", "POST"])
 @login_required
 def download_logs():
 
-    #if post
+    #if post, format is txt or csv
     if request.method == "POST":
-        return redirect(url_for('log_file', filename=app.config['LOG_FILE']))
+        fmt = request.form.get("format", "txt")
+        if fmt not in current_app.config['LOG_FORMATS']:
+            return apology("Unknown log format")
+        filename = os.path.splitext(current_app.config['LOG_FILE'])[0] + "." + fmt
+        return redirect(url_for('.log_file', filename=filename, job=request.form.get("job") or None))
 
     #if get
-    return render_template("logs.html")
+    return render_template("logs.html", job=import_jobs.latest(session["user_id"]))
 
-# log attachment download route
-@app.route('/logfolder/<filename>')
+# log attachment download route, the user's latest job (or ?job=) is streamed in the format of the file extension
+@bp.route('/logfolder/<filename>')
+@login_required
 def log_file(filename):
-    return send_from_directory(app.config['LOG_FOLDER'], filename, as_attachment = True)
+    fmt = os.path.splitext(filename)[1].lstrip(".")
+    if fmt not in current_app.config['LOG_FORMATS']:
+        return apology("Unknown log format", 404)
+
+    job_id = request.args.get("job")
+    job = import_jobs.get(job_id) if job_id else import_jobs.latest(session["user_id"])
+
+    #only the user who uploaded the file can download its log
+    if job is None or job["user_id"] != session["user_id"]:
+        return apology("No upload log found", 404)
+
+    return Response(stream_with_context(import_jobs.report(job["job_id"], fmt)), mimetype=current_app.config['LOG_FORMATS'][fmt],
+                    headers={"Content-Disposition": f"attachment; filename={secure_filename(filename)}"})
 
 
 
 
 # download upload template for db upload
-@app.route('/downloadtemplate', methods=["GET", "POST"])
+@bp.route('/downloadtemplate', methods=["GET", "POST"])
 @login_required
 def download_template():
 
     #if post
     if request.method == "POST":
-        return redirect(url_for('template_file', filename=app.config['TEMPLATE_FILE']))
+        return redirect(url_for('.template_file', filename=current_app.config['TEMPLATE_FILE']))
 
     #if get
     return render_template("addcitydb.html")
 
 # upload template attachment download route
-@app.route('/uploadtemplate/<filename>')
+@bp.route('/uploadtemplate/<filename>')
 def template_file(filename):
-    return send_from_directory(app.config['TEMPLATE_FOLDER'], filename, as_attachment = True)
\ No newline at end of file
+    return send_from_directory(current_app.config['TEMPLATE_FOLDER'], filename, as_attachment = True)
+
+
+def metrics_allowed():
+    """Metrics are open unless METRICS_TOKEN is set, then a matching bearer token is required"""
+    token = current_app.config['METRICS_TOKEN']
+    return not token or request.headers.get("Authorization") == f"Bearer {token}"
+
+
+# metrics in Prometheus text format, summed over every worker
+@bp.route('/metrics')
+def metrics_page():
+    if not metrics_allowed():
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+
+    #cache hit ratios, the counters already live in the shared cache file
+    caches = {"weather": weather_cache.stats(), "geo": geo_cache.stats()}
+    gauges = [
+        ("cache_hit_ratio", "Share of cache lookups that were hits.",
+         [({"cache": name}, stats["hits"] / max(stats["hits"] + stats["misses"], 1)) for name, stats in caches.items()]),
+        ("cache_hits", "Cache hits since the cache file was created.", [({"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        ("cache_misses", "Cache misses since the cache file was created.", [({"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        ("cache_entries", "Entries currently cached.", [({"cache": name}, stats["size"]) for name, stats in caches.items()]),
+    ]
+
+    #connection reuse of the pooled upstream client, counted by the worker answering this scrape
+    upstream_stats = upstream.stats()
+    worker = {"worker": str(os.getpid())}
+    gauges += [
+        ("upstream_requests", "Requests sent by this worker's pooled upstream client.", [(worker, upstream_stats["requests"])]),
+        ("upstream_connections_opened", "Connections this worker's upstream client opened.", [(worker, upstream_stats["connections_opened"])]),
+        ("upstream_connections_reused", "Requests sent on an already open connection.", [(worker, upstream_stats["connections_reused"])]),
+    ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+# slowest requests this worker profiled, as folded stacks (flame graph input)
+@bp.route('/metrics/slow')
+def slow_requests():
+    if not metrics_allowed():
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    if not current_app.config['PROFILE_SLOW_REQUESTS']:
+        return Response("profiling is off, set PROFILE_SLOW_REQUESTS=1\n", status=404, mimetype="text/plain")
+    return Response(profiler.dump(), mimetype="text/plain")
@@ -0,0 +1,113 @@
+"""
+ASGI entry point, for serving many open dashboards from one process:
+
+    uvicorn asgi:application --workers 4
+
+Dashboard streams (/api/dashboard/stream) are served here as coroutines,
+so an open dashboard costs a socket and a subscription instead of a
+thread, and one process can hold thousands of them. They are the only
+async part of the app: every other route is the Flask app, its (sync)
+views on a pool of ASGI_WSGI_WORKERS threads, as under flask run or
+gunicorn. Both kinds of stream use app.DashboardStream for their events.
+Streams need the SQLite session store to read the login; with
+SESSION_TYPE=filesystem they are served by Flask like everything else.
+"""
+import asyncio
+import time
+
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.wrappers import Request
+
+import app as webapp
+
+from app import DashboardStream, create_app, start_background_threads
+from broker import AsyncSubscription
+from sessions import SQLiteSessionInterface
+
+app = create_app()
+flask_application = WSGIMiddleware(app, workers=app.config['ASGI_WSGI_WORKERS'])
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif (scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == "/api/dashboard/stream"
+          and isinstance(app.session_interface, SQLiteSessionInterface)):
+        await dashboard_stream(scope, receive, send)
+    else:
+        await flask_application(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            with app.app_context():
+                start_background_threads()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def session_user(scope):
+    """user_id of the request's session (opened the way Flask opens it), or None when not logged in."""
+    cookie = "; ".join(value.decode("latin-1") for name, value in scope["headers"] if name == b"cookie")
+    session = await asyncio.to_thread(app.session_interface.open_session, app, Request({"HTTP_COOKIE": cookie}))
+    return session.get("user_id")
+
+
+def query_float(scope, name, default=0.0):
+    values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get(name)
+    try:
+        return float(values[0]) if values else default
+    except ValueError:
+        return default
+
+
+async def dashboard_stream(scope, receive, send):
+    """Same events as the Flask route, on the event loop."""
+    started = time.perf_counter()
+    with app.app_context():
+        start_background_threads()
+
+    userid = await session_user(scope)
+    if userid is None:
+        #same as login_required
+        await send({"type": "http.response.start", "status": 302, "headers": [(b"location", b"/login"), (b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    stream = await asyncio.to_thread(DashboardStream, userid, query_float(scope, "since"))
+    stream.subscribe(AsyncSubscription)
+
+    async def write(text):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    async def events():
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")]})
+        webapp.metrics.observe("http_request_duration_seconds", time.perf_counter() - started,
+                               {"route": "/api/dashboard/stream", "method": "GET", "status": "200"})
+        for event in stream.opening():
+            await write(event)
+
+        while True:
+            for event in stream.events(await stream.subscription.wait_async(app.config['STREAM_HEARTBEAT'])):
+                await write(event)
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    #stream until the client goes away (or sending fails)
+    tasks = [asyncio.ensure_future(events()), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        stream.close()
@@ -0,0 +1,91 @@
+"""
+Upstream calls per refresh cycle for a dense city list: one call per city vs grid cells vs grid cells and box calls.
+
+Cities are scattered around a few metro areas, the way uploaded city lists
+cluster in practice. Each strategy refreshes every city once through
+bulkweather.BulkWeather against the fake OpenWeatherMap, with a fresh cache
+in a temporary directory and no rate limit:
+
+    python benchmarks/bulk_weather.py [--cities 5000] [--metros 20] [--spread 0.5] [--grid 0.05]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fakeowm
+import helpers
+
+from bulkweather import BulkWeather
+
+
+def dense_cities(count, metros, spread, seed=0):
+    """count rows with lat/lon, spread degrees around metros random centres."""
+    rng = random.Random(seed)
+    centres = [(rng.uniform(-40, 60), rng.uniform(-120, 140)) for _ in range(metros)]
+    rows = []
+    for i in range(count):
+        lat, lon = rng.choice(centres)
+        rows.append({"city_id": i + 1, "city_name": f"City {i + 1}",
+                     "lat": round(lat + rng.gauss(0, spread / 2), 4), "lon": round(lon + rng.gauss(0, spread / 2), 4)})
+    return rows
+
+
+async def refresh(bulk, rows):
+    try:
+        return await bulk.refresh(rows)
+    finally:
+        #the loop ends with this run
+        await helpers.async_upstream.aclose()
+
+
+def run(owm, rows, grid, box_size, args):
+    """(refresh stats, upstream calls, seconds, share of cities with a cached reading) for one strategy."""
+    with tempfile.TemporaryDirectory() as directory:
+        helpers.init_weather_cache(os.path.join(directory, "weathercache.db"), 600, len(rows) * 2, grid)
+        helpers.init_upstream(args.workers, 3.05, 10, 0, 0.3, base_url=owm.url)
+        bulk = BulkWeather(box_size, args.min_cells, args.match, max_workers=args.workers, deadline=3600)
+
+        before = dict(owm.counts)
+        started = time.perf_counter()
+        stats = asyncio.run(refresh(bulk, rows))
+        elapsed = time.perf_counter() - started
+        calls = sum(owm.counts[kind] - before[kind] for kind in ("weather", "box"))
+
+        covered = sum(helpers.weather_cache.peek(helpers.weather_cache_key(row["lat"], row["lon"])) is not None for row in rows)
+        return stats, calls, elapsed, covered / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cities", type=int, default=5000)
+    parser.add_argument("--metros", type=int, default=20, help="clusters the cities are scattered around")
+    parser.add_argument("--spread", type=float, default=0.5, help="degrees a metro area spans")
+    parser.add_argument("--grid", type=float, default=0.05, help="degrees per grid cell")
+    parser.add_argument("--box-size", type=float, default=1.0, help="degrees per box call tile")
+    parser.add_argument("--min-cells", type=int, default=3)
+    parser.add_argument("--match", type=float, default=0.1, help="max degrees from a cell to its station")
+    parser.add_argument("--workers", type=int, default=8, help="upstream calls in flight")
+    parser.add_argument("--latency", type=float, default=50, help="fake upstream latency in ms")
+    args = parser.parse_args()
+
+    owm = fakeowm.start(latency_ms=args.latency, jitter_ms=0)
+    rows = dense_cities(args.cities, args.metros, args.spread)
+
+    for name, grid, box_size in (("per city", 0, 0), ("grid", args.grid, 0), ("grid + box", args.grid, args.box_size)):
+        stats, calls, elapsed, coverage = run(owm, rows, grid, box_size, args)
+        print(f"{name:>10}: {stats['cells']:5d} cells  {calls:5d} upstream calls ({stats['box_calls']} box)  "
+              f"{calls / len(rows):.3f} calls/city  {elapsed:6.2f} s  {coverage:.1%} of cities refreshed")
+
+    owm.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Query plans and timings of the dashboard hot queries before and after the schema migrations.
+
+Builds a throwaway database with the original (version 0) schema and
+--rows dashboard rows, times each query, runs migrations.migrate and
+times them again:
+
+    python benchmarks/dashboard_schema.py [--rows 1000000] [--repeat 200]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from datagen import BASE_SCHEMA
+from migrations import migrate
+
+
+#(name, sql, args for iteration i)
+QUERIES = [
+    ("index join", "SELECT * FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id WHERE user_id = ?",
+     lambda i, users, cities: (i % users + 1,)),
+    ("addcitydash check", "SELECT * FROM dashboard where user_id = ? AND city_id = ?",
+     lambda i, users, cities: (i % users + 1, i % cities + 1)),
+    ("remove", "DELETE FROM dashboard WHERE user_id = ? AND city_id = ?",
+     lambda i, users, cities: (i % users + 1, i % cities + 1)),
+    ("refresher cities", "SELECT cities.city_id, COUNT(*) AS subscribers FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id GROUP BY cities.city_id",
+     lambda i, users, cities: ()),
+]
+
+
+def build(path, rows, cities):
+    users = rows // 50
+    conn = sqlite3.connect(path, isolation_level=None)
+    for sql in BASE_SCHEMA:
+        conn.execute(sql)
+
+    rng = random.Random(0)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO users (id, username, hash) VALUES (?, ?, 'x')", ((i, f"user{i}") for i in range(1, users + 1)))
+    conn.executemany("INSERT INTO cities (city_id, city_name, country_code, lat, lon, country) VALUES (?, ?, '1', ?, ?, 'US')",
+                     ((i, f"City{i}", rng.uniform(-90, 90), rng.uniform(-180, 180)) for i in range(1, cities + 1)))
+    conn.executemany("INSERT INTO dashboard (user_id, city_id) VALUES (?, ?)",
+                     ((i // 50 + 1, rng.randint(1, cities)) for i in range(rows)))
+    conn.execute("COMMIT")
+    conn.close()
+    return users
+
+
+def measure(path, users, cities, repeat):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA foreign_keys=ON")
+    for name, sql, args in QUERIES:
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, args(0, users, cities))]
+        runs = repeat if args(0, users, cities) else max(repeat // 50, 3)
+
+        #deletes are rolled back so every run sees the same data
+        conn.execute("BEGIN")
+        timings = []
+        for i in range(runs):
+            started = time.perf_counter()
+            conn.execute(sql, args(i, users, cities)).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        conn.execute("ROLLBACK")
+
+        print(f"  {name}: median {statistics.median(timings):.3f} ms over {runs} runs")
+        for step in plan:
+            print(f"      {step}")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="dashboard rows")
+    parser.add_argument("--cities", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "weather.db")
+        started = time.perf_counter()
+        users = build(path, args.rows, args.cities)
+        print(f"built {args.rows} dashboard rows for {users} users in {time.perf_counter() - started:.1f}s")
+
+        print("schema version 0:")
+        measure(path, users, args.cities, args.repeat)
+
+        started = time.perf_counter()
+        version = migrate(path)
+        print(f"migrated to version {version} in {time.perf_counter() - started:.1f}s")
+
+        print(f"schema version {version}:")
+        measure(path, users, args.cities, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
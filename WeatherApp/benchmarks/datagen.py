@@ -0,0 +1,127 @@
+"""
+Synthetic data for benchmarks: a populated weather.db and large upload CSVs.
+
+    python benchmarks/datagen.py db out/weather.db --users 1000 --cities 20000 --per-user 6
+    python benchmarks/datagen.py csv out/upload.csv --rows 100000 --blank-coords 0.1 --invalid 0.05
+"""
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import string
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from werkzeug.security import generate_password_hash
+
+from migrations import migrate
+
+
+#schema weather.db shipped with, before any migration
+BASE_SCHEMA = [
+    "CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, username TEXT NOT NULL, hash TEXT NOT NULL)",
+    "CREATE UNIQUE INDEX username ON users (username)",
+    """CREATE TABLE 'cities' ('city_id' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, 'city_name' TEXT NOT NULL, 'state_code' TEXT,
+       'country_code' TEXT NOT NULL, 'lat' REAL NOT NULL, 'lon' REAL NOT NULL, 'country' TEXT NOT NULL)""",
+    """CREATE TABLE dashboard (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL, city_id INTEGER NOT NULL,
+       FOREIGN KEY(user_id) REFERENCES users(id), FOREIGN KEY(city_id) REFERENCES cities(city_id))""",
+]
+
+COUNTRIES = [("US", "840"), ("CA", "124"), ("GB", "826"), ("FR", "250"), ("DE", "276"), ("IN", "356"), ("BR", "076"), ("JP", "392")]
+
+PASSWORD = "benchmark"
+
+
+def username(i):
+    return f"user{i}"
+
+
+def city_name(rng):
+    """Pronounceable, alphabetic city name that passes the upload checks."""
+    syllables = [rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(rng.randint(2, 4))]
+    return "".join(syllables).title()
+
+
+def create_database(path, users=100, cities=2000, per_user=6, seed=0):
+    """
+    Build a weather.db with users (all with password PASSWORD), cities and dashboards, migrated to the current schema.
+    Migrating first means the triggers fill the R*Tree and FTS indexes as rows go in.
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path, isolation_level=None)
+    for sql in BASE_SCHEMA:
+        conn.execute(sql)
+    conn.close()
+    migrate(path)
+
+    #hashing is deliberately slow, every user shares one hash
+    password_hash = generate_password_hash(PASSWORD)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO users (id, username, hash) VALUES (?, ?, ?)",
+                     ((i, username(i), password_hash) for i in range(1, users + 1)))
+    rows = []
+    for i in range(1, cities + 1):
+        country, code = rng.choice(COUNTRIES)
+        rows.append((i, city_name(rng), code, round(rng.uniform(-60, 70), 4), round(rng.uniform(-180, 180), 4), country))
+    conn.executemany("INSERT INTO cities (city_id, city_name, country_code, lat, lon, country) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.executemany("INSERT OR IGNORE INTO dashboard (user_id, city_id) VALUES (?, ?)",
+                     ((user, rng.randint(1, cities)) for user in range(1, users + 1) for _ in range(per_user)))
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def write_upload_csv(path, rows=10000, blank_coords=0.0, invalid=0.05, duplicates=0.05, seed=0):
+    """Upload file in the template layout with the given shares of rows without lat/lon, invalid rows and duplicates."""
+    rng = random.Random(seed)
+    written = []
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(['city_name', 'state_code', 'country_code', 'lat', 'lon', 'country (2 letter)'])
+        for _ in range(rows):
+            draw = rng.random()
+            if written and draw < duplicates:
+                row = list(rng.choice(written))
+            elif draw < duplicates + invalid:
+                row = [city_name(rng) + rng.choice(string.digits), "x", "abc", "1.2.3", "foo", "USA"]
+            else:
+                country, code = rng.choice(COUNTRIES)
+                row = [city_name(rng), "", code, round(rng.uniform(-60, 70), 4), round(rng.uniform(-180, 180), 4), country]
+                if rng.random() < blank_coords:
+                    row[3] = row[4] = ""
+                written.append(row)
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    db = commands.add_parser("db", help="populated weather.db")
+    db.add_argument("path")
+    db.add_argument("--users", type=int, default=100)
+    db.add_argument("--cities", type=int, default=2000)
+    db.add_argument("--per-user", type=int, default=6, help="dashboard cities per user")
+    db.add_argument("--seed", type=int, default=0)
+
+    upload = commands.add_parser("csv", help="upload file")
+    upload.add_argument("path")
+    upload.add_argument("--rows", type=int, default=10000)
+    upload.add_argument("--blank-coords", type=float, default=0.0, help="share of rows without lat/lon")
+    upload.add_argument("--invalid", type=float, default=0.05)
+    upload.add_argument("--duplicates", type=float, default=0.05)
+    upload.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "db":
+        create_database(args.path, args.users, args.cities, args.per_user, args.seed)
+    else:
+        write_upload_csv(args.path, args.rows, args.blank_coords, args.invalid, args.duplicates, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Per-query latency of the app's hot queries under concurrent load, cs50's SQL vs database.Database.
+
+database.Database runs twice, without and with the query histogram the app
+records (metrics.Metrics), so the cost of timing every query shows up.
+Runs against a copy of weather.db so the real file is never touched:
+
+    python benchmarks/db_latency.py [--threads 8] [--queries 2000]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from database import Database
+from metrics import Metrics
+
+
+QUERIES = [
+    #index()
+    ("SELECT * FROM dashboard JOIN cities ON dashboard.city_id = cities.city_id WHERE user_id = ?", lambda i: (i % 50,)),
+    #login()
+    ("SELECT * FROM users WHERE username = ?", lambda i: (f"user{i % 50}",)),
+    #addcitydash()
+    ("SELECT * FROM dashboard where user_id = ? AND city_id = ?", lambda i: (i % 50, i % 200)),
+]
+
+
+def run(db, threads, queries):
+    """Latencies in ms of every query issued by threads threads running queries queries each."""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        mine = []
+        for i in range(offset, offset + queries):
+            sql, args = QUERIES[i % len(QUERIES)]
+            started = time.perf_counter()
+            db.execute(sql, *args(i))
+            mine.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=worker, args=(n * queries,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "queries": len(latencies),
+        "qps": round(len(latencies) / elapsed),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)], 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "weather.db"))
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=2000, help="queries per thread")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "weather.db")
+        shutil.copy(args.database, path)
+
+        try:
+            from cs50 import SQL
+        except ImportError:
+            print("cs50: not installed, skipped")
+        else:
+            print("cs50:", run(SQL(f"sqlite:///{path}"), args.threads, args.queries))
+
+        db = Database(path, pool_size=args.threads)
+        print("database:", run(db, args.threads, args.queries))
+        db.close()
+
+        db = Database(path, pool_size=args.threads, metrics=Metrics(os.path.join(tmp, "metrics.db")))
+        print("database + metrics:", run(db, args.threads, args.queries))
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
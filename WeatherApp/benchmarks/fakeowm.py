@@ -0,0 +1,198 @@
+"""
+Local stand-in for the OpenWeatherMap endpoints the app calls.
+
+Serves /geo/1.0/direct, /data/2.5/weather and /data/2.5/box/city with the
+same response shapes, deterministic data derived from the query, and
+injectable latency, errors and 429s. box/city reports stations on a
+lattice of --station-spacing degrees. Point the app at it with UPSTREAM_BASE_URL:
+
+    python benchmarks/fakeowm.py --port 8099 --latency 80 --error-rate 0.05 --rate-429 0.01
+    UPSTREAM_BASE_URL=http://127.0.0.1:8099 flask run
+
+Places whose city name starts with "Nowhere" are unknown to the geocoder.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeOWMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    #most stations one box/city answer lists
+    MAX_STATIONS = 1000
+
+    def __init__(self, address, latency_ms=50, jitter_ms=20, error_rate=0.0, rate_429=0.0, retry_after=1, seed=0,
+                 station_spacing=0.1):
+        super().__init__(address, FakeOWMHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.station_spacing = station_spacing
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"geo": 0, "weather": 0, "box": 0, "errors": 0, "throttled": 0}
+
+    def handle_error(self, request, client_address):
+        #clients hanging up (e.g. the app shutting down) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def roll(self):
+        """(delay in seconds, outcome) for one request: "ok", "error" or "429"."""
+        with self.lock:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            draw = self.random.random()
+        if draw < self.rate_429:
+            return delay, "429"
+        if draw < self.rate_429 + self.error_rate:
+            return delay, "error"
+        return delay, "ok"
+
+
+def stable_number(text, low, high):
+    """Deterministic number in [low, high) derived from text."""
+    digest = int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)
+    return low + (high - low) * digest / 0xFFFFFFFF
+
+
+class FakeOWMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/geo/1.0/direct":
+            kind = "geo"
+        elif url.path == "/data/2.5/weather":
+            kind = "weather"
+        elif url.path == "/data/2.5/box/city":
+            kind = "box"
+        else:
+            self.send_json(404, {"cod": 404, "message": "not found"})
+            return
+
+        delay, outcome = self.server.roll()
+        time.sleep(delay)
+
+        if outcome == "429":
+            self.server.count("throttled")
+            self.send_json(429, {"cod": 429, "message": "rate limited"}, [("Retry-After", str(self.server.retry_after))])
+            return
+        if outcome == "error":
+            self.server.count("errors")
+            self.send_json(503, {"cod": 503, "message": "injected error"})
+            return
+
+        self.server.count(kind)
+        if kind == "geo":
+            self.send_json(200, self.geo(query.get("q", "")))
+        elif kind == "box":
+            try:
+                self.send_json(200, self.box(query.get("bbox", "")))
+            except ValueError:
+                self.send_json(400, {"cod": "400", "message": "wrong bbox"})
+        else:
+            self.send_json(200, self.weather(query.get("lat", "0"), query.get("lon", "0")))
+
+    def geo(self, q):
+        parts = [part.strip() for part in q.split(",")]
+        if not parts[0] or parts[0].lower().startswith("nowhere"):
+            return []
+        country = parts[-1] if len(parts) > 1 else "US"
+        return [{
+            "name": parts[0],
+            "lat": round(stable_number(q + "lat", -60, 70), 4),
+            "lon": round(stable_number(q + "lon", -180, 180), 4),
+            "country": country.upper()[:2] if country.isalpha() else "US",
+        }]
+
+    def weather(self, lat, lon):
+        #temperature drifts slowly with time so refreshes see changes
+        base = stable_number(f"{lat},{lon}", 10, 95)
+        temp = round(base + 3 * ((time.time() / 600) % 1), 2)
+        return {
+            "coord": {"lat": float(lat), "lon": float(lon)},
+            "weather": [{"main": "Clouds", "description": "scattered clouds"}],
+            "main": {"temp": temp, "temp_min": round(temp - 4, 2), "temp_max": round(temp + 5, 2)},
+        }
+
+    def box(self, bbox):
+        lon_left, lat_bottom, lon_right, lat_top = (float(value) for value in bbox.split(",")[:4])
+        spacing = self.server.station_spacing
+        stations = []
+        for i in range(math.ceil(lat_bottom / spacing), math.floor(lat_top / spacing) + 1):
+            for j in range(math.ceil(lon_left / spacing), math.floor(lon_right / spacing) + 1):
+                if len(stations) == self.server.MAX_STATIONS:
+                    break
+                lat, lon = round(i * spacing, 4), round(j * spacing, 4)
+                station = self.weather(lat, lon)
+                station.update(id=len(stations) + 1, name=f"Station {lat},{lon}", coord={"Lon": lon, "Lat": lat})
+                stations.append(station)
+        return {"cod": 200, "calctime": 0.01, "cnt": len(stations), "list": stations}
+
+
+def start(port=0, **options):
+    """Start a fake server on a background thread. Returns the server (see .url, .counts, .shutdown())."""
+    server = FakeOWMServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, name="fake-owm", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=50, help="mean latency in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="latency jitter in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--station-spacing", type=float, default=0.1, help="degrees between box/city stations")
+    args = parser.parse_args()
+
+    server = FakeOWMServer(("127.0.0.1", args.port), args.latency, args.jitter, args.error_rate, args.rate_429,
+                           args.retry_after, args.seed, args.station_spacing)
+    print(f"fake OpenWeatherMap on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Scripted load scenarios against a real app server backed by the fake OpenWeatherMap.
+
+Builds a throwaway data directory (datagen), starts benchmarks/fakeowm.py
+in process and the app with `flask run` (plus `flask import-worker`, as in
+production) in subprocesses pointed at it, then
+runs the scenarios over HTTP and prints one JSON object per scenario
+(latency p50/p95/p99 in ms, throughput, errors) for regression tracking:
+
+    python benchmarks/loadtest.py --scenarios login,dashboard,import --output results.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import datagen
+import fakeowm
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * share))], 2)
+
+
+def summarize(scenario, latencies, errors, duration, **extra):
+    """Machine-readable result of one scenario. latencies are in ms."""
+    return dict({
+        "scenario": scenario,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round((len(latencies) + errors) / duration, 1) if duration else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }, **extra)
+
+
+def timed(fn):
+    """(latency in ms, ok) of one call of fn, which returns True on success."""
+    started = time.perf_counter()
+    try:
+        ok = fn()
+    except requests.RequestException:
+        ok = False
+    return (time.perf_counter() - started) * 1000, ok
+
+
+def run_concurrently(calls, concurrency):
+    """Run the calls on concurrency threads. Returns (latencies of successful calls, error count, seconds)."""
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, ok in pool.map(timed, calls):
+            if ok:
+                latencies.append(latency)
+            else:
+                errors += 1
+    return latencies, errors, time.perf_counter() - started
+
+
+def login(base_url, user):
+    session = requests.Session()
+    response = session.post(f"{base_url}/login", data={"username": datagen.username(user), "password": datagen.PASSWORD},
+                            allow_redirects=False, timeout=30)
+    return session, response.status_code == 302 and response.headers.get("Location", "").endswith("/")
+
+
+def login_storm(base_url, users, concurrency, requests_count):
+    """Many users logging in at once (password hashing and session writes)."""
+    calls = [lambda i=i: login(base_url, i % users + 1)[1] for i in range(requests_count)]
+    latencies, errors, duration = run_concurrently(calls, concurrency)
+    return summarize("login_storm", latencies, errors, duration, concurrency=concurrency)
+
+
+def dashboard_fanout(base_url, users, concurrency, requests_count, owm):
+    """Logged-in users loading their dashboards (DB join, cached readings, refresh fan-out)."""
+    sessions = [login(base_url, i % users + 1)[0] for i in range(concurrency)]
+    upstream_before = dict(owm.counts)
+
+    def load(i):
+        session = sessions[i % len(sessions)]
+        return session.get(f"{base_url}/", timeout=30).status_code == 200
+
+    calls = [lambda i=i: load(i) for i in range(requests_count)]
+    latencies, errors, duration = run_concurrently(calls, concurrency)
+
+    api_calls = [lambda i=i: sessions[i % len(sessions)].get(f"{base_url}/api/dashboard", timeout=30).status_code == 200
+                 for i in range(requests_count)]
+    api_latencies, api_errors, api_duration = run_concurrently(api_calls, concurrency)
+
+    upstream_calls = sum(owm.counts[kind] - upstream_before[kind] for kind in ("weather", "box"))
+    return [
+        summarize("dashboard_fanout", latencies, errors, duration, concurrency=concurrency, upstream_weather_calls=upstream_calls),
+        summarize("dashboard_api", api_latencies, api_errors, api_duration, concurrency=concurrency),
+    ]
+
+
+def bulk_import(base_url, data_dir, rows, blank_coords, poll_interval=0.5):
+    """One user uploading a large CSV and polling the job until it finishes."""
+    path = os.path.join(data_dir, "upload.csv")
+    datagen.write_upload_csv(path, rows, blank_coords)
+    session, _ = login(base_url, 1)
+
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        response = session.post(f"{base_url}/fileupload", files={"file": ("upload.csv", f, "text/csv")}, allow_redirects=False, timeout=300)
+    upload_ms = (time.perf_counter() - started) * 1000
+    job_id = response.headers.get("Location", "").split("job=")[-1]
+
+    poll_latencies = []
+    job = {}
+    while True:
+        polled = time.perf_counter()
+        job = session.get(f"{base_url}/fileupload/{job_id}", timeout=30).json()
+        poll_latencies.append((time.perf_counter() - polled) * 1000)
+        if job.get("status") in ("done", "failed", None):
+            break
+        time.sleep(poll_interval)
+    duration = time.perf_counter() - started
+
+    return summarize("bulk_import", poll_latencies, 0 if job.get("status") == "done" else 1, duration,
+                     rows=rows, blank_coords=blank_coords, upload_ms=round(upload_ms, 2), status=job.get("status"),
+                     rows_per_sec=round(rows / duration, 1), success=job.get("success"), warn=job.get("warn"), fail=job.get("fail"))
+
+
+def start_app(data_dir, port, owm_url, env):
+    """
+    Run the app with flask run and the import worker in data_dir (its databases and folders are relative to the working directory).
+
+    Returns ([processes], base url).
+    """
+    app_dir = os.path.dirname(HERE)
+    for folder in ("uploads", "uploadtemplate"):
+        os.makedirs(os.path.join(data_dir, folder), exist_ok=True)
+
+    env = dict(os.environ, PYTHONPATH=app_dir, API_KEY="benchmark", APP_PROFILE="production", UPSTREAM_BASE_URL=owm_url, **env)
+    processes = [subprocess.Popen([sys.executable, "-m", "flask", "--app", "app", *command], cwd=data_dir, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for command in (["run", "--port", str(port), "--with-threads"], ["import-worker"])]
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{base_url}/login", timeout=1)
+            return processes, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    for process in processes:
+        process.kill()
+    raise RuntimeError("app did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default="login,dashboard,import", help="comma separated: login, dashboard, import")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--cities", type=int, default=5000)
+    parser.add_argument("--per-user", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400, help="requests per scenario")
+    parser.add_argument("--import-rows", type=int, default=20000)
+    parser.add_argument("--blank-coords", type=float, default=0.05, help="share of upload rows that need geocoding")
+    parser.add_argument("--latency", type=float, default=80, help="fake upstream latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--output", help="also write the results here as a JSON list")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(",")
+    owm = fakeowm.start(latency_ms=args.latency, error_rate=args.error_rate, rate_429=args.rate_429)
+    results = []
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        datagen.create_database(os.path.join(data_dir, "weather.db"), args.users, args.cities, args.per_user)
+        processes, base_url = start_app(data_dir, args.port, owm.url, {"UPSTREAM_RPM": "100000", "UPSTREAM_BURST": "1000"})
+        try:
+            if "login" in scenarios:
+                results.append(login_storm(base_url, args.users, args.concurrency, args.requests))
+            if "dashboard" in scenarios:
+                results.extend(dashboard_fanout(base_url, args.users, args.concurrency, args.requests, owm))
+            if "import" in scenarios:
+                results.append(bulk_import(base_url, data_dir, args.import_rows, args.blank_coords))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(timeout=10)
+            owm.shutdown()
+
+    #calls the fake upstream served over the whole run
+    results.append(dict({"scenario": "upstream_totals"}, **owm.counts))
+    for result in results:
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Session backend cost at high request rates, Flask-Session's filesystem store vs sessions.SQLiteSessionInterface.
+
+Each backend serves a minimal app with the app's session traffic: logins,
+dashboard views that only read the session, and flash() round trips (write
+then read and consume). Threads share one store in a temporary directory:
+
+    python benchmarks/session_store.py [--threads 8] [--requests 5000] [--users 500]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask, flash, get_flashed_messages, session
+from flask_session import Session
+
+from sessions import SQLiteSessionInterface
+
+
+def make_app(backend, directory):
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "benchmark"
+    app.config["SESSION_PERMANENT"] = False
+    if backend == "filesystem":
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config["SESSION_FILE_DIR"] = os.path.join(directory, "flask_session")
+        Session(app)
+    else:
+        app.session_interface = SQLiteSessionInterface(os.path.join(directory, "sessions.db"))
+
+    @app.route("/login/<int:user>")
+    def login(user):
+        session.clear()
+        session["user_id"] = user
+        return "ok"
+
+    @app.route("/")
+    def index():
+        return str(session.get("user_id")) + "".join(get_flashed_messages())
+
+    @app.route("/add")
+    def add():
+        flash("City added")
+        return "ok"
+
+    return app
+
+
+def run(app, threads, requests_count, users):
+    """Latencies in ms of every request, issued by threads clients each logged in as a user."""
+    latencies = []
+    lock = threading.Lock()
+
+    def client(offset):
+        rng = random.Random(offset)
+        test_client = app.test_client()
+        test_client.get(f"/login/{offset % users}")
+        mine = []
+        for i in range(requests_count // threads):
+            draw = rng.random()
+            if draw < 0.05:
+                url = f"/login/{rng.randrange(users)}"
+            elif draw < 0.25:
+                url = "/add"
+            else:
+                url = "/"
+            started = time.perf_counter()
+            test_client.get(url)
+            mine.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, time.perf_counter() - started
+
+
+def report(name, latencies, elapsed):
+    latencies.sort()
+    print(f"{name:>11}: {len(latencies) / elapsed:8.0f} req/s  mean {statistics.mean(latencies):.3f} ms  "
+          f"p50 {latencies[len(latencies) // 2]:.3f} ms  p99 {latencies[int(len(latencies) * 0.99)]:.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=5000, help="requests per backend, split over the threads")
+    parser.add_argument("--users", type=int, default=500)
+    args = parser.parse_args()
+
+    for backend in ("filesystem", "sqlite"):
+        with tempfile.TemporaryDirectory() as directory:
+            app = make_app(backend, directory)
+            latencies, elapsed = run(app, args.threads, args.requests, args.users)
+            report(backend, latencies, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Worker cold start per config profile: import time of app.py, create_app(), first request and steady-state request latency.
+
+Every run is a fresh interpreter (like a new gunicorn worker) in a throwaway
+data directory, so the jinja bytecode cache of the production profile is
+cold on the first run and warm on the rest:
+
+    python benchmarks/startup.py [--runs 5] [--requests 200]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import datagen
+
+
+#runs inside the new interpreter and prints one JSON line
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+client = application.test_client()
+client.get("/login")
+first = time.perf_counter()
+for _ in range({requests}):
+    client.get("/login")
+done = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "create_ms": (created - imported) * 1000,
+    "first_request_ms": (first - created) * 1000,
+    "request_us": (done - first) / {requests} * 1e6,
+    "pandas_loaded": "pandas" in sys.modules,
+}}))
+"""
+
+
+def run(profile, data_dir, requests_count):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(HERE), API_KEY="benchmark", APP_PROFILE=profile)
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", PROBE.format(requests=requests_count)], cwd=data_dir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per profile")
+    parser.add_argument("--requests", type=int, default=200, help="requests timed after the first one")
+    args = parser.parse_args()
+
+    for profile in ("development", "production"):
+        with tempfile.TemporaryDirectory() as data_dir:
+            datagen.create_database(os.path.join(data_dir, "weather.db"), users=10, cities=100)
+            results = [run(profile, data_dir, args.requests) for _ in range(args.runs)]
+
+        print(f"{profile:>11}: process {statistics.median(r['process_ms'] for r in results):7.1f} ms  "
+              f"import {statistics.median(r['import_ms'] for r in results):6.1f} ms  "
+              f"create_app {statistics.median(r['create_ms'] for r in results):6.1f} ms  "
+              f"first request cold {results[0]['first_request_ms']:5.1f} ms, "
+              f"warm {statistics.median(r['first_request_ms'] for r in results[1:] or results):5.1f} ms  "
+              f"then {statistics.median(r['request_us'] for r in results):6.0f} us/request  "
+              f"pandas at startup: {any(r['pandas_loaded'] for r in results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import threading
+import time
+
+
+class Subscription:
+    """Latest pending update per cache key for one connected client."""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self._pending = {}
+        self._ready = threading.Condition()
+
+    def publish(self, key, value, stored_at):
+        with self._ready:
+            #a client that falls behind only gets the newest reading per key
+            self._pending[key] = (value, stored_at)
+            self._ready.notify()
+
+    def wait(self, timeout):
+        """Block until updates arrive (or timeout). Returns {stored key: (value, stored_at)}, empty on timeout."""
+        with self._ready:
+            if not self._pending:
+                self._ready.wait(timeout)
+            updates = self._pending
+            self._pending = {}
+        return updates
+
+
+class AsyncSubscription(Subscription):
+    """Subscription for a coroutine: the broker thread wakes it through its event loop."""
+
+    def __init__(self, keys):
+        super().__init__(keys)
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def publish(self, key, value, stored_at):
+        with self._ready:
+            self._pending[key] = (value, stored_at)
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait_async(self, timeout):
+        """Wait for updates without blocking the loop. Returns {stored key: (value, stored_at)}, empty on timeout."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+        with self._ready:
+            updates = self._pending
+            self._pending = {}
+        return updates
+
+
+class ReadingBroker:
+    """
+    Fan cache refreshes out to every dashboard stream in this process.
+
+    One thread per process polls the shared cache for entries set since the
+    last version it saw (a single indexed query, whichever worker did the
+    refresh; versions follow commit order, so a slow commit is not skipped)
+    and hands each one to the subscriptions watching that key. So open
+    dashboards never cause upstream calls of their own: a thousand
+    clients on one city share the refresher's one call. It only polls
+    while someone is subscribed.
+    """
+
+    def __init__(self, cache, poll_interval=1):
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._version = cache.version()
+
+    def start(self):
+        """Start the broker thread once per process (safe to call on every request, and after a fork)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="reading-broker", daemon=True)
+                self._thread.start()
+
+    def subscribe(self, keys, subscription_class=Subscription):
+        """Watch keys. Pass subscription_class=AsyncSubscription from a coroutine."""
+        subscription = subscription_class(keys)
+        with self._lock:
+            for key in subscription.keys:
+                self._subscriptions.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                watchers = self._subscriptions.get(key)
+                if watchers is not None:
+                    watchers.discard(subscription)
+                    if not watchers:
+                        del self._subscriptions[key]
+
+    def poll(self):
+        """Publish entries stored since the last poll to their subscribers."""
+        for key, value, stored_at, version in self.cache.changed_since(self._version):
+            self._version = version
+            with self._lock:
+                watchers = list(self._subscriptions.get(key, ()))
+            for subscription in watchers:
+                subscription.publish(key, value, stored_at)
+
+    def _run(self):
+        while True:
+            try:
+                if self._subscriptions:
+                    self.poll()
+                else:
+                    #nobody listening, start from the latest version when someone subscribes
+                    self._version = self.cache.version()
+            except Exception:
+                logging.getLogger(__name__).exception("reading broker poll failed")
+            time.sleep(self.poll_interval)
@@ -0,0 +1,161 @@
+"""
+Refresh readings for many cities with as few upstream calls as possible.
+
+Cities are first reduced to their weather grid cells (helpers.weather_cache_key),
+so a dense city list costs one reading per cell instead of one per city. Cells
+are then grouped into tiles of box_size degrees: a tile holding at least
+min_cells cells is fetched with a single box/city call, and every cell in it
+takes the reading of the nearest station within match_distance degrees. Cells
+in sparse tiles, cells with no station close enough, and whole tiles whose box
+call fails fall back to one weather call per cell.
+"""
+import asyncio
+import math
+
+import helpers
+
+
+def plan_boxes(cells, box_size, min_cells):
+    """
+    Split grid cells (lat, lon) into box calls and single calls.
+
+    Returns ([(bbox, cells)], single cells), bbox being (lon_left, lat_bottom,
+    lon_right, lat_top) around the cells of one tile. With box_size 0 every
+    cell is a single call.
+    """
+    if box_size <= 0:
+        return [], list(cells)
+
+    tiles = {}
+    for cell in cells:
+        tiles.setdefault((math.floor(cell[0] / box_size), math.floor(cell[1] / box_size)), []).append(cell)
+
+    boxes = []
+    singles = []
+    for members in tiles.values():
+        if len(members) < min_cells:
+            singles.extend(members)
+            continue
+        lats = [lat for lat, lon in members]
+        lons = [lon for lat, lon in members]
+        boxes.append(((min(lons), min(lats), max(lons), max(lats)), members))
+    return boxes, singles
+
+
+def nearest_reading(cell, stations, max_distance):
+    """Reading of the station closest to cell, or None if none is within max_distance degrees."""
+    best = None
+    best_distance = max_distance
+    shrink = math.cos(math.radians(cell[0]))
+    for lat, lon, reading in stations:
+        #degrees of longitude shrink away from the equator
+        distance = math.hypot(lat - cell[0], (lon - cell[1]) * shrink)
+        if distance <= best_distance:
+            best = reading
+            best_distance = distance
+    return best
+
+
+class BulkWeather:
+    """
+    Batched refreshes for the background refresher.
+
+    refresh(rows) runs on an event loop and uses the async upstream client,
+    so every call still waits for the shared rate limit and fails fast while
+    the breaker is open. At most max_workers calls are in flight, and calls
+    still running after deadline seconds are cancelled (their cells stay due
+    and are picked up by the next batch). Box calls take the cache lease of
+    every cell they cover, so another worker refilling the same cells waits
+    for the box reading instead of calling upstream itself.
+    """
+
+    def __init__(self, box_size=1.0, min_cells=3, match_distance=0.1, zoom=10, max_workers=8, deadline=5, lease_ttl=10):
+        self.box_size = box_size
+        self.min_cells = min_cells
+        self.match_distance = match_distance
+        self.zoom = zoom
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.lease_ttl = lease_ttl
+
+    @staticmethod
+    def cell_key(cell):
+        return [cell[0], cell[1], helpers.WEATHER_UNITS]
+
+    def _claim(self, cells):
+        """The cells whose lease this worker got, the rest are being refilled elsewhere."""
+        cache = helpers.weather_cache
+        if cache is None:
+            return list(cells)
+        return [cell for cell in cells if cache.acquire_lease(self.cell_key(cell), self.lease_ttl)]
+
+    def _release(self, cells):
+        if helpers.weather_cache is not None:
+            for cell in cells:
+                helpers.weather_cache.release_lease(self.cell_key(cell))
+
+    def _store(self, readings):
+        for cell, reading in readings.items():
+            if helpers.weather_cache is not None:
+                helpers.weather_cache.set(self.cell_key(cell), reading)
+            #every fetched reading goes into the history too, as in refill_weather_async
+            if helpers.weather_history is not None:
+                helpers.weather_history.record(cell[0], cell[1], reading)
+
+    async def refresh(self, rows):
+        """
+        Fetch new readings for the grid cells of rows (with lat and lon).
+
+        Returns counts of distinct cells, box calls and single calls made,
+        and cells that got a new reading.
+        """
+        cells = list(dict.fromkeys(tuple(helpers.weather_cache_key(row["lat"], row["lon"])[:2]) for row in rows))
+        stats = {"cells": len(cells), "box_calls": 0, "single_calls": 0, "refreshed": 0}
+        if not cells:
+            return stats
+
+        boxes, singles = plan_boxes(cells, self.box_size, self.min_cells)
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def single(cell):
+            async with semaphore:
+                stats["single_calls"] += 1
+                reading = await helpers.refill_weather_async(self.cell_key(cell), cell[0], cell[1], force=True)
+            if reading is not None:
+                stats["refreshed"] += 1
+
+        async def box(bbox, members):
+            claimed = await asyncio.to_thread(self._claim, members)
+            if not claimed:
+                return
+            leftover = claimed
+            try:
+                #widen the box so stations just outside the outermost cells can still be matched
+                margin = self.match_distance
+                bbox = tuple(round(value, 4) for value in (bbox[0] - margin, bbox[1] - margin, bbox[2] + margin, bbox[3] + margin))
+                async with semaphore:
+                    stats["box_calls"] += 1
+                    stations = await helpers.fetch_box_async(bbox, self.zoom)
+
+                readings = {}
+                if stations:
+                    for cell in claimed:
+                        reading = nearest_reading(cell, stations, self.match_distance)
+                        if reading is not None:
+                            readings[cell] = reading
+                await asyncio.to_thread(self._store, readings)
+                stats["refreshed"] += len(readings)
+                leftover = [cell for cell in claimed if cell not in readings]
+            finally:
+                await asyncio.to_thread(self._release, claimed)
+
+            await asyncio.gather(*(single(cell) for cell in leftover))
+
+        tasks = [asyncio.ensure_future(box(bbox, members)) for bbox, members in boxes]
+        tasks += [asyncio.ensure_future(single(cell)) for cell in singles]
+        done, not_done = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in not_done:
+            task.cancel()
+        #let cancelled calls unwind (and release their leases) before returning
+        await asyncio.gather(*not_done, return_exceptions=True)
+        return stats
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+
+def shared_connection(local, path):
+    """Autocommit WAL connection to a file shared between workers, one per thread."""
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        local.conn = conn
+    return conn
+
+
+class SQLiteCache:
+    """
+    TTL + LRU cache stored in a SQLite file.
+
+    Every gunicorn worker opens the same file, so a reading fetched by one
+    worker is a hit for all of them. Entries older than ttl seconds count as
+    misses, and once a namespace holds more than max_entries rows the least
+    recently used ones are evicted. Hit/miss/eviction counters live in the
+    same file so they add up across workers, next to a per-namespace version
+    counter that set() bumps inside its write transaction, so versions
+    follow commit order even when a slow writer stamped stored_at first.
+    """
+
+    def __init__(self, path, namespace, ttl=600, max_entries=5000):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connect(self):
+        return shared_connection(self._local, self.path)
+
+    def _create_tables(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache_entries (
+                                namespace TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                value TEXT NOT NULL,
+                                stored_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL,
+                                version INTEGER NOT NULL DEFAULT 0,
+                                PRIMARY KEY (namespace, key)) WITHOUT ROWID""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache_stats (
+                                namespace TEXT PRIMARY KEY NOT NULL,
+                                hits INTEGER NOT NULL DEFAULT 0,
+                                misses INTEGER NOT NULL DEFAULT 0,
+                                evictions INTEGER NOT NULL DEFAULT 0,
+                                version INTEGER NOT NULL DEFAULT 0)""")
+            #files created before entries had versions
+            for table in ("cache_entries", "cache_stats"):
+                if "version" not in [column[1] for column in conn.execute(f"PRAGMA table_info({table})")]:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute("DROP INDEX IF EXISTS cache_entries_stored")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (namespace, accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_version ON cache_entries (namespace, version)")
+            conn.execute("INSERT OR IGNORE INTO cache_stats (namespace) VALUES (?)", (self.namespace,))
+        conn.execute("""CREATE TABLE IF NOT EXISTS cache_leases (
+                            namespace TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            expires_at REAL NOT NULL,
+                            PRIMARY KEY (namespace, key)) WITHOUT ROWID""")
+
+    @staticmethod
+    def make_key(key):
+        return json.dumps(key, separators=(",", ":"))
+
+    def _count(self, conn, column, amount=1):
+        conn.execute(f"UPDATE cache_stats SET {column} = {column} + ? WHERE namespace = ?", (amount, self.namespace))
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or older than the TTL."""
+        conn = self._connect()
+        skey = self.make_key(key)
+        now = time.time()
+
+        row = conn.execute("SELECT value, stored_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                           (self.namespace, skey)).fetchone()
+
+        if row is None or now - row[1] > self.ttl:
+            self._count(conn, "misses")
+            return None
+
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                         (now, self.namespace, skey))
+            self._count(conn, "hits")
+
+        return json.loads(row[0])
+
+    def entry(self, key):
+        """Return (value, stored_at) for key whether or not it is fresh, or None. stored_at doubles as the value's version."""
+        conn = self._connect()
+        row = conn.execute("SELECT value, stored_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                           (self.namespace, self.make_key(key))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def entries(self, keys, batch=500):
+        """
+        Return {stored key: (value, stored_at)} for those of keys that are cached, fresh or not, reading each batch in one query.
+
+        Counted like get(): fresh entries are hits, missing or stale ones are misses, and every entry found is marked as used.
+        """
+        conn = self._connect()
+        skeys = list(dict.fromkeys(self.make_key(key) for key in keys))
+        now = time.time()
+        found = {}
+
+        for start in range(0, len(skeys), batch):
+            part = skeys[start:start + batch]
+            rows = conn.execute(f"SELECT key, value, stored_at FROM cache_entries WHERE namespace = ? AND key IN ({','.join('?' * len(part))})",
+                                (self.namespace, *part)).fetchall()
+            for skey, value, stored_at in rows:
+                found[skey] = (json.loads(value), stored_at)
+
+        if skeys:
+            hits = sum(1 for value, stored_at in found.values() if now - stored_at <= self.ttl)
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                                 ((now, self.namespace, skey) for skey in found))
+                self._count(conn, "hits", hits)
+                self._count(conn, "misses", len(skeys) - hits)
+
+        return found
+
+    def peek(self, key):
+        """Return (value, age in seconds) for key whether or not it is fresh, or None. Doesn't touch counters."""
+        cached = self.entry(key)
+        if cached is None:
+            return None
+        return cached[0], time.time() - cached[1]
+
+    def version(self):
+        """Version of the latest set() committed in this namespace, for a later changed_since()."""
+        conn = self._connect()
+        return conn.execute("SELECT version FROM cache_stats WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def changed_since(self, version, limit=1000):
+        """Return [(stored key, value, stored_at, version)] for entries set after version, in commit order."""
+        conn = self._connect()
+        rows = conn.execute("""SELECT key, value, stored_at, version FROM cache_entries WHERE namespace = ? AND version > ?
+                               ORDER BY version LIMIT ?""", (self.namespace, version, limit)).fetchall()
+        return [(key, json.loads(value), stored_at, version) for key, value, stored_at, version in rows]
+
+    def set(self, key, value):
+        """Store value under key, evicting least recently used entries past max_entries."""
+        conn = self._connect()
+        now = time.time()
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            #taken under the write lock, so a reader that has seen version n has seen every commit before it
+            version = conn.execute("UPDATE cache_stats SET version = version + 1 WHERE namespace = ? RETURNING version",
+                                   (self.namespace,)).fetchone()[0]
+            conn.execute("""INSERT OR REPLACE INTO cache_entries (namespace, key, value, stored_at, accessed_at, version)
+                            VALUES (?, ?, ?, ?, ?, ?)""", (self.namespace, self.make_key(key), json.dumps(value), now, now, version))
+
+            size = conn.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+            excess = size - self.max_entries
+            if excess > 0:
+                conn.execute("""DELETE FROM cache_entries WHERE namespace = ? AND key IN
+                                (SELECT key FROM cache_entries WHERE namespace = ? ORDER BY accessed_at LIMIT ?)""",
+                             (self.namespace, self.namespace, excess))
+                self._count(conn, "evictions", excess)
+
+    def acquire_lease(self, key, lease_ttl):
+        """Try to become the one worker allowed to refill key. Leases expire after lease_ttl seconds."""
+        conn = self._connect()
+        skey = self.make_key(key)
+        now = time.time()
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT expires_at FROM cache_leases WHERE namespace = ? AND key = ?",
+                               (self.namespace, skey)).fetchone()
+            if row is not None and row[0] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO cache_leases (namespace, key, expires_at) VALUES (?, ?, ?)",
+                         (self.namespace, skey, now + lease_ttl))
+            return True
+
+    def renew_lease(self, key, lease_ttl):
+        """Push back the expiry of a lease this worker already holds."""
+        conn = self._connect()
+        conn.execute("UPDATE cache_leases SET expires_at = ? WHERE namespace = ? AND key = ?",
+                     (time.time() + lease_ttl, self.namespace, self.make_key(key)))
+
+    def release_lease(self, key):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_leases WHERE namespace = ? AND key = ?", (self.namespace, self.make_key(key)))
+
+    def fetch_once(self, key, fetch, lease_ttl=10, poll_interval=0.1, force=False):
+        """
+        Refill key by calling fetch() in only one worker at a time.
+
+        The worker holding the lease calls fetch() and stores the result; the
+        others poll the cache and return the value it stores. If the holder
+        gives up without storing anything, the next poller takes the lease
+        over, and after lease_ttl seconds a waiter stops waiting and fetches
+        on its own. With force, waiters only accept a value stored after they
+        started waiting.
+        """
+        started = time.time()
+        give_up = started + lease_ttl
+
+        while True:
+            if self.acquire_lease(key, lease_ttl):
+                try:
+                    value = fetch()
+                    if value is not None:
+                        self.set(key, value)
+                    return value
+                finally:
+                    self.release_lease(key)
+
+            time.sleep(poll_interval)
+            cached = self.peek(key)
+            max_age = time.time() - started if force else self.ttl
+            if cached is not None and cached[1] <= max_age:
+                return cached[0]
+
+            if time.time() > give_up:
+                return fetch()
+
+    async def fetch_once_async(self, key, fetch, lease_ttl=10, poll_interval=0.1, force=False):
+        """fetch_once() for coroutines: fetch is a coroutine function and SQLite work runs on worker threads."""
+        started = time.time()
+        give_up = started + lease_ttl
+
+        while True:
+            if await asyncio.to_thread(self.acquire_lease, key, lease_ttl):
+                try:
+                    value = await fetch()
+                    if value is not None:
+                        await asyncio.to_thread(self.set, key, value)
+                    return value
+                finally:
+                    await asyncio.to_thread(self.release_lease, key)
+
+            await asyncio.sleep(poll_interval)
+            cached = await asyncio.to_thread(self.peek, key)
+            max_age = time.time() - started if force else self.ttl
+            if cached is not None and cached[1] <= max_age:
+                return cached[0]
+
+            if time.time() > give_up:
+                return await fetch()
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current size for this namespace."""
+        conn = self._connect()
+        hits, misses, evictions = conn.execute("SELECT hits, misses, evictions FROM cache_stats WHERE namespace = ?",
+                                               (self.namespace,)).fetchone()
+        size = conn.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": evictions,
+            "size": size
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key within a process.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        skey = SQLiteCache.make_key(key)
+
+        with self._lock:
+            call = self._calls.get(skey)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[skey] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[skey]
+            call.done.set()
+
+        return call.result
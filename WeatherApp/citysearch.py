@@ -0,0 +1,82 @@
+import re
+
+
+#longest page the typeahead endpoint will return
+MAX_PAGE_SIZE = 50
+
+#only this many words of the search text are used, each becomes one prefix term
+MAX_TERMS = 4
+
+
+def create_city_search(conn):
+    """
+    Create cities_fts, an FTS5 index over city name and country kept in step with cities by triggers.
+
+    It is an external-content table (the text stays in cities) with prefix
+    indexes for 1 to 3 characters, so typeahead prefixes are looked up
+    directly instead of scanning the term list. Runs in the caller's
+    transaction (see migrations).
+    """
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS cities_fts USING fts5 (
+                        city_name, country, content='cities', content_rowid='city_id',
+                        tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS cities_fts_insert AFTER INSERT ON cities BEGIN
+                        INSERT INTO cities_fts (rowid, city_name, country) VALUES (new.city_id, new.city_name, new.country);
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS cities_fts_update AFTER UPDATE OF city_name, country ON cities BEGIN
+                        INSERT INTO cities_fts (cities_fts, rowid, city_name, country) VALUES ('delete', old.city_id, old.city_name, old.country);
+                        INSERT INTO cities_fts (rowid, city_name, country) VALUES (new.city_id, new.city_name, new.country);
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS cities_fts_delete AFTER DELETE ON cities BEGIN
+                        INSERT INTO cities_fts (cities_fts, rowid, city_name, country) VALUES ('delete', old.city_id, old.city_name, old.country);
+                    END""")
+    conn.execute("INSERT INTO cities_fts (cities_fts) VALUES ('rebuild')")
+
+
+def fts_query(text):
+    """Turn typed text into an FTS5 query matching every word as a prefix, or None if it has no words."""
+    words = re.findall(r"\w+", text)[:MAX_TERMS]
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def page_cursor(row):
+    """Cursor for the page after row: its city_id and name, as "id:name"."""
+    return f"{row['city_id']}:{row['city_name']}"
+
+
+def parse_cursor(cursor):
+    """(city_name, city_id) from page_cursor(), or None for the first page (no cursor, or not one of ours)."""
+    city_id, sep, city_name = (cursor or "").partition(":")
+    if not sep or not city_id.isdigit():
+        return None
+    return city_name, int(city_id)
+
+
+def search_cities(db, text, after=None, limit=20):
+    """
+    One page of cities whose name or country start with the words in text, in alphabetical order.
+
+    Pages are keyed on (city_name, city_id) (pass the cursor a page returns
+    as after), so the first page of every search starts with the first name
+    in the alphabet and no page depends on how deep it is; without search
+    text every page is one range lookup on the cities_name_country index.
+    limit is capped at MAX_PAGE_SIZE. Returns (cities, next cursor or None).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = fts_query(text or "")
+    after_name, after_id = parse_cursor(after) or ("", 0)
+
+    #fetch one extra row to know whether there is a next page
+    if query is None:
+        rows = db.execute("""SELECT city_id, city_name, state_code, country FROM cities
+                             WHERE (city_name, city_id) > (?, ?) ORDER BY city_name, city_id LIMIT ?""", after_name, after_id, limit + 1)
+    else:
+        rows = db.execute("""SELECT city_id, city_name, state_code, country FROM cities
+                             WHERE city_id IN (SELECT rowid FROM cities_fts WHERE cities_fts MATCH ?) AND (city_name, city_id) > (?, ?)
+                             ORDER BY city_name, city_id LIMIT ?""", query, after_name, after_id, limit + 1)
+
+    if len(rows) > limit:
+        return rows[:limit], page_cursor(rows[limit - 1])
+    return rows, None
@@ -0,0 +1,153 @@
+"""
+Settings for each profile, picked by APP_PROFILE (development unless set).
+
+Every setting read from the environment here can still be overridden there.
+"""
+import os
+
+
+class Config:
+
+    # Configure server-side sessions (instead of signed cookies): "sqlite" keeps them in one WAL file shared by all workers,
+    # "filesystem" is Flask-Session's one pickle file per session. Seconds between sweeps of expired sessions.
+    SESSION_PERMANENT = False
+    SESSION_TYPE = os.environ.get("SESSION_TYPE", "sqlite")
+    SESSION_SQLITE_PATH = 'sessions.db'
+    SESSION_SWEEP_INTERVAL = int(os.environ.get("SESSION_SWEEP_INTERVAL", 300))
+
+    # Configure metrics shared by all workers (file, seconds between writes of this worker's totals, seconds without a write
+    # before a worker's rows are folded into one retired row, optional bearer token for /metrics)
+    METRICS_PATH = 'metrics.db'
+    METRICS_FLUSH_INTERVAL = int(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+    METRICS_RETIRE_AFTER = int(os.environ.get("METRICS_RETIRE_AFTER", 600))
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+    # Configure sampling profiler for slow requests (off unless PROFILE_SLOW_REQUESTS is set, seconds that make a request slow, requests kept)
+    PROFILE_SLOW_REQUESTS = bool(os.environ.get("PROFILE_SLOW_REQUESTS"))
+    PROFILE_THRESHOLD = float(os.environ.get("PROFILE_THRESHOLD", 0.5))
+    PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 10))
+
+    # Configure pooled SQLite data layer (WAL mode, pooled connections kept per process, page cache in KiB, mmap window in MiB)
+    DATABASE = 'weather.db'
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+    DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16384))
+    DB_MMAP_SIZE_MB = int(os.environ.get("DB_MMAP_SIZE_MB", 256))
+
+    # Configure upload directory (uploads are spooled here until their import job finishes)
+    UPLOAD_FOLDER = 'uploads/'
+
+    # Configure max file upload size, in MB
+    MAX_CONTENT_LENGTH = 16 * (1024 * 1024)
+
+    # configure allowable file extensions
+    ALLOWED_EXTENSIONS = ['.csv']
+
+    # configure upload log download name, the extension picks the format (txt or csv)
+    LOG_FILE = 'log.txt'
+    LOG_FORMATS = {'txt': 'text/plain', 'csv': 'text/csv'}
+
+    # configure template directory and file and columns
+    TEMPLATE_FOLDER = 'uploadtemplate'
+    TEMPLATE_FILE = 'uploadtemplate.csv'
+    TEMPLATE_COLUMNS = ['city_name', 'state_code', 'country_code', 'lat', 'lon', 'country (2 letter)']
+
+    # configure rows inserted per transaction during file uploads
+    IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 500))
+
+    # configure background import jobs (threads per process, seconds without progress before a job is taken over, whether web workers
+    # run jobs too or only `flask --app app import-worker` does, days finished jobs and their logs are kept)
+    IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", 2))
+    IMPORT_STALE_AFTER = int(os.environ.get("IMPORT_STALE_AFTER", 120))
+    IMPORT_IN_WEB = os.environ.get("IMPORT_IN_WEB", "1") == "1"
+    IMPORT_KEEP_DAYS = int(os.environ.get("IMPORT_KEEP_DAYS", 30))
+
+    # configure concurrent geocoding of upload rows without lat/lon
+    IMPORT_GEO_WORKERS = int(os.environ.get("IMPORT_GEO_WORKERS", 4))
+
+    # configure weather fan-out for refresh batches (max upstream calls in flight, seconds to wait for the whole batch)
+    WEATHER_MAX_WORKERS = int(os.environ.get("WEATHER_MAX_WORKERS", 8))
+    WEATHER_DEADLINE = float(os.environ.get("WEATHER_DEADLINE", 5))
+
+    # configure weather grid (degrees per cell, cities in one cell share a reading, 0 for exact coordinates)
+    WEATHER_GRID = float(os.environ.get("WEATHER_GRID", 0.05))
+
+    # configure bulk refreshes (degrees per box/city call tile, 0 for single calls only, cells a tile needs for a box call,
+    # max degrees from a cell to the station it takes its reading from, map zoom sent with box calls, cities per refresh batch)
+    WEATHER_BOX_SIZE = float(os.environ.get("WEATHER_BOX_SIZE", 1.0))
+    WEATHER_BOX_MIN_CELLS = int(os.environ.get("WEATHER_BOX_MIN_CELLS", 3))
+    WEATHER_BOX_MATCH = float(os.environ.get("WEATHER_BOX_MATCH", 0.1))
+    WEATHER_BOX_ZOOM = int(os.environ.get("WEATHER_BOX_ZOOM", 10))
+    WEATHER_REFRESH_BATCH = int(os.environ.get("WEATHER_REFRESH_BATCH", 500))
+
+    # configure pooled upstream client (base url, connections kept alive per host, timeouts in seconds, retries for GETs)
+    UPSTREAM_BASE_URL = os.environ.get("UPSTREAM_BASE_URL", "https://api.openweathermap.org")
+    UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 10))
+    UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+    UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10))
+    UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 2))
+    UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", 0.3))
+
+    # configure weather cache shared by all workers (seconds a reading stays fresh, max cached coordinates)
+    WEATHER_CACHE_PATH = 'weathercache.db'
+    WEATHER_CACHE_TTL = int(os.environ.get("WEATHER_CACHE_TTL", 600))
+    WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", 5000))
+
+    # configure reading history (file, hours of raw readings, days of hourly and of daily rollups kept)
+    HISTORY_PATH = 'weatherhistory.db'
+    HISTORY_RAW_HOURS = int(os.environ.get("HISTORY_RAW_HOURS", 48))
+    HISTORY_HOURLY_DAYS = int(os.environ.get("HISTORY_HOURLY_DAYS", 30))
+    HISTORY_DAILY_DAYS = int(os.environ.get("HISTORY_DAILY_DAYS", 730))
+
+    # configure geocode cache in the weather cache file (seconds a place is kept, seconds a "not found" answer is kept, max cached places)
+    GEO_CACHE_TTL = int(os.environ.get("GEO_CACHE_TTL", 30 * 86400))
+    GEO_CACHE_NEGATIVE_TTL = int(os.environ.get("GEO_CACHE_NEGATIVE_TTL", 86400))
+    GEO_CACHE_SIZE = int(os.environ.get("GEO_CACHE_SIZE", 50000))
+
+    # configure upstream rate limit shared by all workers (calls per minute for our OpenWeatherMap plan, burst size, seconds a call may wait for budget)
+    UPSTREAM_RPM = int(os.environ.get("UPSTREAM_RPM", 50))
+    UPSTREAM_BURST = int(os.environ.get("UPSTREAM_BURST", 10))
+    UPSTREAM_LIMIT_WAIT = float(os.environ.get("UPSTREAM_LIMIT_WAIT", 10))
+
+    # configure upstream circuit breaker (failure ratio that trips it, min calls in the window before it can trip, window and cool-down in seconds)
+    BREAKER_THRESHOLD = float(os.environ.get("BREAKER_THRESHOLD", 0.5))
+    BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", 10))
+    BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", 60))
+    BREAKER_COOLDOWN = int(os.environ.get("BREAKER_COOLDOWN", 30))
+
+    # configure background weather refresher (seconds between refreshes for hot/cold cities, dashboards that make a city hot)
+    WEATHER_REFRESH_HOT = int(os.environ.get("WEATHER_REFRESH_HOT", 300))
+    WEATHER_REFRESH_COLD = int(os.environ.get("WEATHER_REFRESH_COLD", 1800))
+    WEATHER_HOT_SUBSCRIBERS = int(os.environ.get("WEATHER_HOT_SUBSCRIBERS", 2))
+
+    # configure live dashboard streams (seconds between checks of the cache for new readings, seconds between keep-alives)
+    STREAM_POLL_INTERVAL = float(os.environ.get("STREAM_POLL_INTERVAL", 1))
+    STREAM_HEARTBEAT = int(os.environ.get("STREAM_HEARTBEAT", 15))
+
+    # configure the ASGI entry point (asgi.py): threads serving the sync routes, while dashboard streams run on the event loop
+    ASGI_WSGI_WORKERS = int(os.environ.get("ASGI_WSGI_WORKERS", 32))
+
+    # folder for compiled templates kept across restarts, None to compile them on every start
+    JINJA_CACHE_FOLDER = None
+
+
+class DevelopmentConfig(Config):
+
+    # Ensure templates are auto-reloaded
+    TEMPLATES_AUTO_RELOAD = True
+
+
+class ProductionConfig(Config):
+
+    # templates only change with a deploy: no stat() of every template on each render,
+    # and compiled templates are loaded from disk instead of compiled again by every new worker
+    TEMPLATES_AUTO_RELOAD = False
+    JINJA_CACHE_FOLDER = os.environ.get("JINJA_CACHE_FOLDER", 'jinjacache')
+
+    # imports run in a process of their own (flask --app app import-worker), so they don't compete with requests for the GIL
+    IMPORT_IN_WEB = os.environ.get("IMPORT_IN_WEB", "0") == "1"
+
+
+PROFILES = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig
+}
@@ -0,0 +1,130 @@
+import queue
+import re
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+
+def dict_row(cursor, row):
+    """Row factory returning plain dicts, like cs50's SQL did."""
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+#table a statement reads or writes, for the query timing label
+TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+['\"]?(\w+)", re.IGNORECASE)
+
+
+def statement_label(sql):
+    """Short label for a statement, its verb and first table: "SELECT cities"."""
+    command = sql.lstrip().split(None, 1)[0].upper()
+    table = TABLE_PATTERN.search(sql)
+    return f"{command} {table.group(1)}" if table else command
+
+
+class Database:
+    """
+    Thin SQLite data layer with the same execute() as cs50's SQL.
+
+    Connections are opened once and kept in a pool, and each call borrows
+    one, so a thread keeps reusing warm connections and their prepared
+    statement caches instead of parsing every query again. The file runs in
+    WAL mode with synchronous=NORMAL, so an upload's writes no longer block
+    readers, and each connection gets a memory-mapped read window and a
+    larger page cache. Statements run in autocommit mode. With metrics set
+    every execute() is timed into db_query_duration_seconds by statement.
+    """
+
+    def __init__(self, path, pool_size=16, busy_timeout=30, cache_size_kb=16384, mmap_size_mb=256,
+                 statement_cache=256, row_factory=dict_row, metrics=None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
+        self.statement_cache = statement_cache
+        self.row_factory = row_factory
+        self.metrics = metrics
+        self._labels = {}
+        if metrics is not None:
+            metrics.describe("db_query_duration_seconds", "histogram", "Time spent in Database.execute() by statement verb and table.")
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+        #journal_mode is stored in the file, so every connection (including the importer's) uses WAL from here on
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        self._release(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.statement_cache)
+        conn.row_factory = self.row_factory
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size_mb) * 1024 * 1024}")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+
+    def execute(self, sql, *args):
+        """
+        Run one statement with ? placeholders.
+
+        Returns a list of rows for statements that return rows, the new row's
+        id for INSERT, and the number of rows changed for UPDATE/DELETE.
+        Constraint violations raise ValueError, as with cs50.
+        """
+        if self.metrics is None:
+            return self._execute(sql, args)
+
+        label = self._labels.get(sql)
+        if label is None:
+            label = self._labels[sql] = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            return self._execute(sql, args)
+        finally:
+            self.metrics.observe("db_query_duration_seconds", time.perf_counter() - started, {"statement": label})
+
+    def _execute(self, sql, args):
+        with self.connection() as conn:
+            try:
+                cursor = conn.execute(sql, args)
+            except sqlite3.IntegrityError as e:
+                raise ValueError(str(e)) from e
+
+            if cursor.description is not None:
+                return cursor.fetchall()
+
+            command = sql.lstrip().split(None, 1)[0].upper()
+            if command in ("INSERT", "REPLACE"):
+                return cursor.lastrowid if cursor.rowcount > 0 else None
+            return cursor.rowcount
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -1,9 +1,279 @@
+import asyncio
+import httpx
+import math
 import os
+import random
 import requests
+import threading
+import time
 import urllib.parse
+import weakref
 
+from cache import SingleFlight, SQLiteCache
+from concurrent.futures import ThreadPoolExecutor
 from flask import redirect, render_template, request, session
 from functools import wraps
+from history import WeatherHistory
+from requests.adapters import HTTPAdapter
+
+
+#units requested from the weather API, part of the cache key
+WEATHER_UNITS = "imperial"
+
+#shared weather cache and the grid (in degrees, 0 for none) its keys are snapped to, set up by init_weather_cache
+weather_cache = None
+weather_grid = 0
+
+#history of fetched readings, set up by init_weather_history
+weather_history = None
+
+#shared geocode cache and how long "not found" answers are kept, set up by init_geo_cache
+geo_cache = None
+geo_negative_ttl = 86400
+
+#fetch_geo result when the geocoder answered but knows no such place (cached, unlike upstream failures)
+GEO_NOT_FOUND = {"missing": True}
+
+
+class UpstreamUnavailable(requests.RequestException):
+    """Raised instead of calling upstream while the breaker is open or the rate limit is used up."""
+
+
+def record_outcome(breaker, response, trial):
+    """Report a call's response (None when it got none) to breaker. 429s trip it for as long as Retry-After asks."""
+    if response is None:
+        breaker.record(False, trial=trial)
+    elif response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        breaker.record(False, float(retry_after) if retry_after.isdigit() else 0, trial)
+    else:
+        breaker.record(response.status_code < 500, trial=trial)
+
+
+class UpstreamClient:
+    """
+    Pooled, keep-alive HTTP client for OpenWeatherMap.
+
+    Connections are reused across calls and threads (up to pool_size per
+    host), every call has a (connect, read) timeout, and idempotent GETs are
+    retried on connection errors and 5xx responses with jittered exponential
+    backoff. An optional shared token bucket caps the call rate across
+    workers, and an optional circuit breaker fails calls fast while the
+    upstream keeps erroring or answering 429. Every attempt, retries
+    included, takes its own token and reports its outcome to the breaker.
+    base_url points the client at OpenWeatherMap or a stand-in (see
+    benchmarks/fakeowm.py). With metrics set every attempt is timed into
+    upstream_request_duration_seconds by endpoint and status.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.3,
+                 limiter=None, breaker=None, limit_wait=10, base_url="https://api.openweathermap.org", metrics=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        #retries happen in get(), so each one is rate limited and seen by the breaker
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.limiter = limiter
+        self.breaker = breaker
+        self.limit_wait = limit_wait
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.describe("upstream_request_duration_seconds", "histogram", "OpenWeatherMap calls by endpoint and status (error when no response).")
+
+    def available(self):
+        return self.breaker is None or not self.breaker.is_open()
+
+    def get(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._attempt(url)
+                if response.status_code < 500 or attempt == self.retries:
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt + random.uniform(0, self.backoff))
+
+    def _attempt(self, url):
+        #don't spend a rate limit token (or a timeout) on an upstream we know is failing
+        if not self.available():
+            raise UpstreamUnavailable("circuit breaker open")
+
+        if self.limiter is not None and not self.limiter.take(self.limit_wait):
+            raise UpstreamUnavailable("rate limit budget used up")
+
+        if self.breaker is None:
+            return self._send(url)
+
+        allowed, trial = self.breaker.allow()
+        if not allowed:
+            raise UpstreamUnavailable("circuit breaker open")
+
+        try:
+            response = self._send(url)
+        except requests.RequestException:
+            record_outcome(self.breaker, None, trial)
+            raise
+        except BaseException:
+            #no outcome to record, but a trial call must not keep the breaker half-open for good
+            self.breaker.abandon(trial)
+            raise
+
+        record_outcome(self.breaker, response, trial)
+        return response
+
+    def _send(self, url):
+        if self.metrics is None:
+            return self.session.get(url, timeout=self.timeout)
+
+        status = "error"
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            status = str(response.status_code)
+            return response
+        finally:
+            self.metrics.observe("upstream_request_duration_seconds", time.perf_counter() - started,
+                                 {"endpoint": urllib.parse.urlsplit(url).path, "status": status})
+
+    def stats(self):
+        """Connection reuse statistics summed over every host pool."""
+        pools = self._adapter.poolmanager.pools
+        opened = 0
+        sent = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return {
+            "requests": sent,
+            "connections_opened": opened,
+            "connections_reused": max(sent - opened, 0)
+        }
+
+
+class AsyncUpstreamClient:
+    """
+    UpstreamClient for coroutines, on httpx.
+
+    Shares the sync client's rate limiter, circuit breaker and metrics (their
+    SQLite calls run on worker threads, so the event loop never blocks).
+    httpx connections belong to one event loop, so every loop gets its own
+    pooled keep-alive client: use it from long-lived loops (the refresher's),
+    and call aclose() before a short-lived loop ends. Connection errors and
+    5xx answers are retried like the sync client does, each attempt with its
+    own token and breaker outcome.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.3,
+                 limiter=None, breaker=None, limit_wait=10, base_url="https://api.openweathermap.org", metrics=None):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = limiter
+        self.breaker = breaker
+        self.limit_wait = limit_wait
+        self.metrics = metrics
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            client = self._clients[loop] = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return client
+
+    async def aclose(self):
+        """Close the running loop's client."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _take(self):
+        """limiter.take(limit_wait) that waits on the loop, so cancelling the call stops the wait (and takes no token)."""
+        give_up = time.monotonic() + self.limit_wait
+        while True:
+            taken, wait = await asyncio.to_thread(self.limiter.try_take)
+            if taken:
+                return True
+            if time.monotonic() + wait > give_up:
+                return False
+            await asyncio.sleep(wait)
+
+    async def get(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self._attempt(url)
+                if response.status_code < 500 or attempt == self.retries:
+                    return response
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt + random.uniform(0, self.backoff))
+
+    async def _attempt(self, url):
+        if self.breaker is not None and await asyncio.to_thread(self.breaker.is_open):
+            raise UpstreamUnavailable("circuit breaker open")
+
+        if self.limiter is not None and not await self._take():
+            raise UpstreamUnavailable("rate limit budget used up")
+
+        if self.breaker is None:
+            return await self._send(url)
+
+        trial = False
+        try:
+            #the trial is claimed here on the loop, so a cancellation can't land between claiming and this try
+            allowed, trial = self.breaker.allow(await asyncio.to_thread(self.breaker.open_until))
+            if not allowed:
+                raise UpstreamUnavailable("circuit breaker open")
+
+            try:
+                response = await self._send(url)
+            except httpx.HTTPError:
+                #the thread reports the outcome even if this task is cancelled meanwhile
+                reporting, trial = trial, False
+                await asyncio.to_thread(record_outcome, self.breaker, None, reporting)
+                raise
+
+            reporting, trial = trial, False
+            await asyncio.to_thread(record_outcome, self.breaker, response, reporting)
+            return response
+        finally:
+            #cancelled (e.g. at a batch deadline) before an outcome: a trial call must not keep the breaker half-open for good
+            self.breaker.abandon(trial)
+
+    async def _send(self, url):
+        status = "error"
+        started = time.perf_counter()
+        try:
+            response = await self._client().get(url)
+            status = str(response.status_code)
+            return response
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe("upstream_request_duration_seconds", time.perf_counter() - started,
+                                     {"endpoint": urllib.parse.urlsplit(url).path, "status": status})
+
+
+#module-level clients for all upstream calls, replaced by init_upstream with configured values
+upstream = UpstreamClient()
+async_upstream = AsyncUpstreamClient()
+
+#identical geocoder calls in flight at the same time share one request
+_geo_flight = SingleFlight()
+
+#shared pool for upload geocoding, sized on first use
+_geo_pool = None
+_geo_pool_lock = threading.Lock()
 
 
 def apology(message, code=400):
@@ -35,24 +305,81 @@ def login_required(f):
     return decorated_function
 
 
+def geo_cache_key(city_name, state_code, country_code):
+    """Normalized (city, state, country) key, so spelling variants in case and spacing share an entry."""
+    return [" ".join(part.split()).lower() for part in (city_name, state_code or "", country_code)]
+
+
 def lookup_geo(city_name, state_code, country_code):
 
+    #answer from the shared geocode cache first, including remembered misses
+    key = geo_cache_key(city_name, state_code, country_code)
+    geo = cached_geo(key)
+
+    #concurrent lookups for the same place (e.g. during bulk adds) share one upstream call
+    if geo is None:
+        geo = _geo_flight.do(key, lambda: refill_geo(key, city_name, state_code, country_code))
+
+    if geo is None or geo.get("missing"):
+        return None
+    return geo
+
+
+def cached_geo(key):
+    """Cached geocode for key, GEO_NOT_FOUND for a remembered miss, or None if there is nothing usable."""
+    if geo_cache is None:
+        return None
+    geo = geo_cache.get(key)
+    if geo is not None and geo.get("missing"):
+        if geo["until"] > time.time():
+            return GEO_NOT_FOUND
+        return None
+    return geo
+
+
+def refill_geo(key, city_name, state_code, country_code):
+    def fetch():
+        geo = fetch_geo(city_name, state_code, country_code)
+        #remember misses for a shorter time than hits
+        if geo is GEO_NOT_FOUND:
+            return dict(GEO_NOT_FOUND, until=time.time() + geo_negative_ttl)
+        return geo
+
+    if geo_cache is None:
+        return fetch()
+    return geo_cache.fetch_once(key, fetch)
+
+
+def fetch_geo(city_name, state_code, country_code):
+
     # Contact API
     try:
-        api_key = os.environ.get("API_KEY")
-        if state_code == None:
-            url = f"http://api.openweathermap.org/geo/1.0/direct?q={urllib.parse.quote_plus(city_name)},{urllib.parse.quote_plus(country_code)}&limit=1&appid={api_key}"
-        else:
-            url = f"http://api.openweathermap.org/geo/1.0/direct?q={urllib.parse.quote_plus(city_name)},{urllib.parse.quote_plus(state_code)},{urllib.parse.quote_plus(country_code)}&limit=1&appid={api_key}"
-        response = requests.get(url)
+        response = upstream.get(geo_url(city_name, state_code, country_code))
         response.raise_for_status()
     except requests.RequestException:
         return None
 
+    return parse_geo(response)
+
+
+def geo_url(city_name, state_code, country_code):
+    api_key = os.environ.get("API_KEY")
+    if state_code == None:
+        return f"{upstream.base_url}/geo/1.0/direct?q={urllib.parse.quote_plus(city_name)},{urllib.parse.quote_plus(country_code)}&limit=1&appid={api_key}"
+    return f"{upstream.base_url}/geo/1.0/direct?q={urllib.parse.quote_plus(city_name)},{urllib.parse.quote_plus(state_code)},{urllib.parse.quote_plus(country_code)}&limit=1&appid={api_key}"
+
+
+def parse_geo(response):
+    """Geocode from a geocoder response (requests or httpx), GEO_NOT_FOUND for an unknown place, None if unreadable."""
+
     # Parse response
     try:
         geo = response.json()
 
+        #an empty list means the geocoder has no such place
+        if geo == []:
+            return GEO_NOT_FOUND
+
         #json response is a list of dicts so we want the first object
         geo = geo[0]
 
@@ -66,31 +393,208 @@ def lookup_geo(city_name, state_code, country_code):
     except (KeyError, TypeError, ValueError, IndexError):
         return None
 
-def lookup_weather(lat, lon, city_name, city_id):
-    # Contact API
+
+def lookup_geo_many(places, max_workers=4):
+    """
+    Geocode (city, state, country) places concurrently. Returns {place: geo or None}.
+
+    Distinct places are looked up on a shared pool of max_workers threads;
+    cache hits return at once and every upstream call still waits for the
+    shared rate limit.
+    """
+    global _geo_pool
+
+    places = list(dict.fromkeys(places))
+    if not places:
+        return {}
+
+    with _geo_pool_lock:
+        if _geo_pool is None:
+            _geo_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="geo")
+
+    futures = [_geo_pool.submit(lookup_geo, *place) for place in places]
+    results = {}
+    for place, future in zip(places, futures):
+        results[place] = future.result() if future.exception() is None else None
+    return results
+
+
+def init_upstream(pool_size, connect_timeout, read_timeout, retries, backoff, limiter=None, breaker=None, limit_wait=10,
+                  base_url="https://api.openweathermap.org", metrics=None):
+    """Replace the upstream clients (sync and async, sharing limiter and breaker) with ones built from app config."""
+    global upstream, async_upstream
+    upstream = UpstreamClient(pool_size, connect_timeout, read_timeout, retries, backoff, limiter, breaker, limit_wait, base_url,
+                              metrics)
+    async_upstream = AsyncUpstreamClient(pool_size, connect_timeout, read_timeout, retries, backoff, limiter, breaker, limit_wait,
+                                         base_url, metrics)
+    return upstream
+
+
+def init_geo_cache(path, ttl, negative_ttl, max_entries):
+    """Open the geocode cache shared by every worker."""
+    global geo_cache, geo_negative_ttl
+    geo_cache = SQLiteCache(path, "geo", ttl=ttl, max_entries=max_entries)
+    geo_negative_ttl = negative_ttl
+    return geo_cache
+
+
+def init_weather_history(path, resolve_cities, raw_retention, hourly_retention, daily_retention):
+    """Open the reading history every fetched reading is recorded in."""
+    global weather_history
+    weather_history = WeatherHistory(path, resolve_cities, raw_retention, hourly_retention, daily_retention)
+    return weather_history
+
+
+def init_weather_cache(path, ttl, max_entries, grid=0):
+    """Open the weather cache shared by every worker, keyed by cells of grid degrees (0 for exact coordinates)."""
+    global weather_cache, weather_grid
+    weather_cache = SQLiteCache(path, "weather", ttl=ttl, max_entries=max_entries)
+    weather_grid = grid
+    return weather_cache
+
+
+def snap_coordinates(lat, lon):
+    """Centre of the grid cell holding lat/lon, so cities a few km apart share one reading (no-op without a grid)."""
+    lat, lon = float(lat), float(lon)
+    if weather_grid > 0:
+        lat = (math.floor(lat / weather_grid) + 0.5) * weather_grid
+        lon = (math.floor(lon / weather_grid) + 0.5) * weather_grid
+    return lat, lon
+
+
+def weather_cache_key(lat, lon, units=WEATHER_UNITS):
+    """Cache key for a reading: the grid cell's coordinates, rounded so float noise doesn't split entries."""
+    lat, lon = snap_coordinates(lat, lon)
+    return [round(lat, 4), round(lon, 4), units]
+
+
+def weather_url(lat, lon):
+    api_key = os.environ.get("API_KEY")
+
+    #request imperial unit weather data
+    return f"{upstream.base_url}/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units={WEATHER_UNITS}"
+
+
+def parse_weather(response):
+    """Reading from a weather response (requests or httpx), None if unreadable."""
+
+    # Parse response
     try:
-        api_key = os.environ.get("API_KEY")
+        return reading_from(response.json())
 
-        #request imperial unit weather data
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=imperial"
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException:
+    except (KeyError, TypeError, ValueError, IndexError):
         return None
 
-    # Parse response
+
+def reading_from(weather):
+    """Reading from one weather object, as in weather and box/city responses."""
+    return {
+        "temp_current": int(weather["main"]["temp"]),
+        "temp_min": int(weather["main"]["temp_min"]),
+        "temp_max": int(weather["main"]["temp_max"]),
+        "conditions": weather["weather"][0]["description"]
+    }
+
+
+def box_url(bbox, zoom):
+    api_key = os.environ.get("API_KEY")
+    lon_left, lat_bottom, lon_right, lat_top = bbox
+
+    #current weather of every station OpenWeatherMap shows in the box at this map zoom
+    return f"{upstream.base_url}/data/2.5/box/city?bbox={lon_left},{lat_bottom},{lon_right},{lat_top},{zoom}&appid={api_key}&units={WEATHER_UNITS}"
+
+
+def parse_box(response):
+    """Stations from a box/city response (requests or httpx) as [(lat, lon, reading)], None if unreadable."""
     try:
-        weather = response.json()
+        stations = []
+        for city in response.json()["list"]:
+            #box/city spells its coordinates Lat/Lon
+            coord = {name.lower(): value for name, value in city["coord"].items()}
+            stations.append((float(coord["lat"]), float(coord["lon"]), reading_from(city)))
+        return stations
 
-        return {
-            "temp_current": int(weather["main"]["temp"]),
-            "temp_min": int(weather["main"]["temp_min"]),
-            "temp_max": int(weather["main"]["temp_max"]),
-            "city": city_name,
-            "city_id": city_id,
-            "conditions": weather["weather"][0]["description"]
-        }
+    except (KeyError, TypeError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def unavailable_weather(city_name, city_id):
+    """Placeholder card for a city whose weather could not be fetched in time."""
+    return {
+        "city": city_name,
+        "city_id": city_id,
+        "unavailable": True
+    }
+
+
+async def refill_weather_async(key, lat, lon, force=False):
+    """
+    Fetch a reading for key's grid cell (lat/lon being its centre) in one
+    worker at a time and store it, with force even if the cached one is
+    still fresh. Returns the reading, or None if upstream failed.
+    """
+    async def fetch():
+        reading = await fetch_weather_async(lat, lon)
+        #every fetched reading goes into the history too, so trends cost no extra calls
+        if reading is not None and weather_history is not None:
+            await asyncio.to_thread(weather_history.record, lat, lon, reading)
+        return reading
+
+    if weather_cache is None:
+        return await fetch()
+    return await weather_cache.fetch_once_async(key, fetch, force=force)
+
+
+async def fetch_weather_async(lat, lon):
+    try:
+        response = await async_upstream.get(weather_url(lat, lon))
+        response.raise_for_status()
+    except (httpx.HTTPError, UpstreamUnavailable):
+        return None
 
+    return parse_weather(response)
 
-    except (KeyError, TypeError, ValueError):
+
+async def fetch_box_async(bbox, zoom=10):
+    """Readings of the stations in bbox (lon_left, lat_bottom, lon_right, lat_top) in one call, None on failure."""
+    try:
+        response = await async_upstream.get(box_url(bbox, zoom))
+        response.raise_for_status()
+    except (httpx.HTTPError, UpstreamUnavailable):
         return None
+
+    return parse_box(response)
+
+
+def cached_weather(rows):
+    """
+    Last known reading for every dashboard row, without calling upstream.
+
+    Returns the cards (each with the reading's age in seconds and the time
+    it was stored, or an unavailable card if nothing is cached yet) and the
+    rows whose reading is missing or older than the cache TTL, so the caller
+    can queue a refresh.
+    """
+    city_list = []
+    stale_rows = []
+    now = time.time()
+
+    #one read for the whole dashboard, counted in the cache's hit/miss stats
+    keys = [weather_cache_key(row["lat"], row["lon"]) for row in rows]
+    entries = weather_cache.entries(keys) if weather_cache else {}
+
+    for row, key in zip(rows, keys):
+        cached = entries.get(SQLiteCache.make_key(key))
+
+        if cached is None:
+            city_list.append(unavailable_weather(row["city_name"], row["city_id"]))
+            stale_rows.append(row)
+            continue
+
+        reading, updated_at = cached
+        age = now - updated_at
+        city_list.append(dict(reading, city=row["city_name"], city_id=row["city_id"], age=int(age), updated_at=updated_at))
+        if age > weather_cache.ttl:
+            stale_rows.append(row)
+
+    return city_list, stale_rows
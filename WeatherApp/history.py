@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+from cache import shared_connection
+
+
+#rollup resolutions in seconds
+HOURLY = 3600
+DAILY = 86400
+
+
+class WeatherHistory:
+    """
+    Time series of readings per city, downsampled as it ages.
+
+    Every reading is stored raw and folded into hourly and daily rollups
+    (count, sum, min, max) in the same transaction, so downsampling costs
+    nothing extra and never has to re-read raw data. Each level keeps its
+    own retention; expired rows are pruned at most once per prune_interval.
+    All tables are WITHOUT ROWID and clustered on (city_id, time), with
+    integer timestamps, so a range query for a sparkline is one contiguous
+    index scan. resolve_cities(lat, lon) maps a reading's coordinates to the
+    city ids it belongs to.
+    """
+
+    def __init__(self, path, resolve_cities, raw_retention=2 * DAILY, hourly_retention=30 * DAILY,
+                 daily_retention=730 * DAILY, prune_interval=HOURLY):
+        self.path = path
+        self.resolve_cities = resolve_cities
+        self.raw_retention = raw_retention
+        self.hourly_retention = hourly_retention
+        self.daily_retention = daily_retention
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._pruned_at = 0
+
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS history_raw (
+                            city_id INTEGER NOT NULL,
+                            ts INTEGER NOT NULL,
+                            temp REAL NOT NULL,
+                            temp_min REAL NOT NULL,
+                            temp_max REAL NOT NULL,
+                            PRIMARY KEY (city_id, ts)) WITHOUT ROWID""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS history_rollup (
+                            city_id INTEGER NOT NULL,
+                            resolution INTEGER NOT NULL,
+                            bucket INTEGER NOT NULL,
+                            count INTEGER NOT NULL,
+                            temp_sum REAL NOT NULL,
+                            temp_min REAL NOT NULL,
+                            temp_max REAL NOT NULL,
+                            PRIMARY KEY (city_id, resolution, bucket)) WITHOUT ROWID""")
+
+    def _connect(self):
+        return shared_connection(self._local, self.path)
+
+    def record(self, lat, lon, reading, ts=None):
+        """Store a fetched reading for every city at lat/lon. Never raises, history must not break the refresh."""
+        try:
+            city_ids = self.resolve_cities(lat, lon)
+            if not city_ids:
+                return
+            ts = int(ts if ts is not None else time.time())
+            temp, temp_min, temp_max = reading["temp_current"], reading["temp_min"], reading["temp_max"]
+
+            conn = self._connect()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT OR REPLACE INTO history_raw (city_id, ts, temp, temp_min, temp_max) VALUES (?, ?, ?, ?, ?)",
+                                 [(city_id, ts, temp, temp_min, temp_max) for city_id in city_ids])
+                conn.executemany("""INSERT INTO history_rollup (city_id, resolution, bucket, count, temp_sum, temp_min, temp_max)
+                                    VALUES (?, ?, ?, 1, ?, ?, ?)
+                                    ON CONFLICT (city_id, resolution, bucket) DO UPDATE SET
+                                        count = count + 1, temp_sum = temp_sum + excluded.temp_sum,
+                                        temp_min = MIN(temp_min, excluded.temp_min), temp_max = MAX(temp_max, excluded.temp_max)""",
+                                 [(city_id, resolution, ts - ts % resolution, temp, temp_min, temp_max)
+                                  for city_id in city_ids for resolution in (HOURLY, DAILY)])
+
+            if ts - self._pruned_at >= self.prune_interval:
+                self.prune(ts)
+        except Exception:
+            logging.getLogger(__name__).exception("recording weather history failed")
+
+    def prune(self, now=None):
+        """Drop rows older than each level's retention."""
+        now = int(now if now is not None else time.time())
+        self._pruned_at = now
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM history_raw WHERE ts < ?", (now - self.raw_retention,))
+            conn.execute("DELETE FROM history_rollup WHERE resolution = ? AND bucket < ?", (HOURLY, now - self.hourly_retention))
+            conn.execute("DELETE FROM history_rollup WHERE resolution = ? AND bucket < ?", (DAILY, now - self.daily_retention))
+
+    def resolution_for(self, start, now):
+        """Finest level that still holds data back to start: 0 (raw), HOURLY or DAILY."""
+        if start >= now - self.raw_retention:
+            return 0
+        if start >= now - self.hourly_retention:
+            return HOURLY
+        return DAILY
+
+    def series(self, city_ids, start, end=None):
+        """
+        Readings for each city between start and end, as columns.
+
+        Returns {city_id: {"resolution", "ts", "temp", "temp_min", "temp_max"}}
+        with one list per column, at the finest resolution that covers start
+        (rollups give the average temp of each bucket).
+        """
+        now = int(time.time())
+        end = int(end if end is not None else now)
+        start = int(start)
+        resolution = self.resolution_for(start, now)
+
+        result = {city_id: {"resolution": resolution, "ts": [], "temp": [], "temp_min": [], "temp_max": []} for city_id in city_ids}
+        conn = self._connect()
+        for city_id in city_ids:
+            if resolution == 0:
+                rows = conn.execute("""SELECT ts, temp, temp_min, temp_max FROM history_raw
+                                       WHERE city_id = ? AND ts BETWEEN ? AND ? ORDER BY ts""", (city_id, start, end))
+            else:
+                rows = conn.execute("""SELECT bucket, ROUND(temp_sum / count, 2), temp_min, temp_max FROM history_rollup
+                                       WHERE city_id = ? AND resolution = ? AND bucket BETWEEN ? AND ? ORDER BY bucket""",
+                                    (city_id, resolution, start - start % resolution, end))
+
+            columns = result[city_id]
+            for ts, temp, temp_min, temp_max in rows:
+                columns["ts"].append(ts)
+                columns["temp"].append(temp)
+                columns["temp_min"].append(temp_min)
+                columns["temp_max"].append(temp_max)
+
+        return result
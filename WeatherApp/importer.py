@@ -0,0 +1,265 @@
+import logging
+import math
+import sqlite3
+
+from collections import defaultdict
+from itertools import islice
+
+
+#lat/lon increment range for the duplicate check, 0.5 is meant to represent a roughly 30 mile difference
+LAT_LON_RANGE = 0.5
+
+
+#columns of the upload template, in order
+COLUMNS = ['city_name', 'state_code', 'country_code', 'lat', 'lon', 'country (2 letter)']
+
+CITY_NAME_PATTERN = r"^[a-zA-z]+\s?[a-zA-Z]+\s?[a-zA-Z]+\s?$"
+NUMBER_PATTERN = r"^-?(0|[1-9]\d*)(\.\d+)?$"
+
+
+def per_value(column, check):
+    """Run a column check once per distinct value and broadcast the mask back to every row."""
+    import pandas as pd
+
+    codes, uniques = pd.factorize(column)
+    return pd.Series(check(pd.Series(uniques, dtype=column.dtype)).to_numpy(dtype=bool)[codes], index=column.index)
+
+
+def validate_rows(rows, geocoding=False):
+    """
+    Validate a batch of upload rows a column at a time.
+
+    Every check runs over a whole column of a DataFrame and yields a boolean
+    error mask (low-cardinality columns are checked once per distinct value),
+    and messages are only built for the rows that fail. With pyarrow
+    installed pandas runs the string checks natively. With geocoding, rows
+    that leave both lat and lon blank are valid (their coordinates are looked
+    up later). Returns the error messages for each row (empty if the row is
+    valid), in the same order the row-by-row checks logged them.
+    """
+    #pandas is imported on the first upload instead of at startup, it takes longer to import than the rest of the app
+    import numpy as np
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(rows, columns=COLUMNS).fillna("").astype(str)
+    lat = df["lat"]
+    lon = df["lon"]
+    country = df["country (2 letter)"]
+
+    lat_numeric = lat.str.match(NUMBER_PATTERN)
+    lon_numeric = lon.str.match(NUMBER_PATTERN)
+    lat_value = lat.where(lat_numeric, "nan").astype("float64")
+    lon_value = lon.where(lon_numeric, "nan").astype("float64")
+    to_geocode = (lat == "") & (lon == "") if geocoding else pd.Series(False, index=df.index)
+
+    #(error mask, message or function of the row number building the message)
+    checks = [
+        (per_value(df["city_name"], lambda values: ~values.str.match(CITY_NAME_PATTERN)),
+         "City name is not alphabetic or was not entered. Please update city name to only alphabetic characters."),
+        (per_value(df["state_code"], lambda values: (values != "") & ~values.str.isnumeric()),
+         "State code is not numeric. Please update state code to only numeric characters"),
+        (per_value(df["country_code"], lambda values: ~values.str.isnumeric()),
+         "Country code is not numeric or was not entered. Please update country code to only numeric characters"),
+        (~lat_numeric & ~to_geocode,
+         lambda i: f"Lat \'{lat[i]}\' is not numeric or was not entered. Please update lat to only numeric characters with the exception of '-' and '.'"),
+        (lat_numeric & ~lat_value.between(-90, 90),
+         lambda i: f"Lat \'{lat[i]}\' is out of range. Please update lat to a value between -90 and 90"),
+        (~lon_numeric & ~to_geocode,
+         lambda i: f"Lon \'{lon[i]}\' is not numeric or was not entered. Please update lon to only numeric characters with the exception of '-' and '.'"),
+        (lon_numeric & ~lon_value.between(-180, 180),
+         lambda i: f"Lon \'{lon[i]}\' is out of range. Please update lon to a value between -180 and 180"),
+        (per_value(country, lambda values: ~values.str.isalpha()),
+         "Country is not alphabetic or was not entered. Please update country to only alphabetic characters"),
+        (per_value(country, lambda values: values.str.len() != 2),
+         "Country is not 2 letters in length or was not entered. Please update country to its 2 letter abbreviation"),
+    ]
+
+    #valid rows all share one empty tuple, failing rows get their own list
+    errors = [()] * len(df)
+    for mask, message in checks:
+        for i in np.flatnonzero(mask.to_numpy(dtype=bool)):
+            if not errors[i]:
+                errors[i] = []
+            errors[i].append(message(i) if callable(message) else message)
+
+    return errors
+
+
+def create_city_indexes(conn):
+    """
+    Create the indexes used by the duplicate check, if they don't exist yet.
+
+    cities_rtree is an R*Tree over every city's coordinates, kept in step
+    with the cities table by triggers, and cities_name_country covers the
+    name/country part of the check. Runs in the caller's transaction (see
+    migrations).
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS cities_name_country ON cities (city_name, country_code, country)")
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS cities_rtree USING rtree (city_id, min_lat, max_lat, min_lon, max_lon)")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS cities_rtree_insert AFTER INSERT ON cities BEGIN
+                        INSERT INTO cities_rtree VALUES (new.city_id, new.lat, new.lat, new.lon, new.lon);
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS cities_rtree_update AFTER UPDATE OF lat, lon ON cities BEGIN
+                        UPDATE cities_rtree SET min_lat = new.lat, max_lat = new.lat, min_lon = new.lon, max_lon = new.lon
+                        WHERE city_id = new.city_id;
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS cities_rtree_delete AFTER DELETE ON cities BEGIN
+                        DELETE FROM cities_rtree WHERE city_id = old.city_id;
+                    END""")
+    #backfill cities added before the triggers existed
+    conn.execute("""INSERT INTO cities_rtree SELECT city_id, lat, lat, lon, lon FROM cities
+                    WHERE city_id NOT IN (SELECT city_id FROM cities_rtree)""")
+
+
+def in_database(conn, city, lat, lon):
+    """True if the db already has this city within LAT_LON_RANGE of lat/lon (R*Tree window query)."""
+    cityname, country_code, country = city
+    row = conn.execute("""SELECT 1 FROM cities_rtree JOIN cities ON cities.city_id = cities_rtree.city_id
+                          WHERE cities_rtree.max_lat >= ? AND cities_rtree.min_lat <= ?
+                          AND cities_rtree.max_lon >= ? AND cities_rtree.min_lon <= ?
+                          AND cities.lat BETWEEN ? AND ? AND cities.lon BETWEEN ? AND ?
+                          AND city_name = ? AND country_code = ? AND country = ? LIMIT 1""",
+                       (lat - LAT_LON_RANGE, lat + LAT_LON_RANGE, lon - LAT_LON_RANGE, lon + LAT_LON_RANGE,
+                        lat - LAT_LON_RANGE, lat + LAT_LON_RANGE, lon - LAT_LON_RANGE, lon + LAT_LON_RANGE,
+                        cityname, country_code, country)).fetchone()
+    return row is not None
+
+
+class UploadGrid:
+    """Cities accepted earlier in the same upload, bucketed in LAT_LON_RANGE sized cells."""
+
+    def __init__(self):
+        self.cells = defaultdict(list)
+
+    @staticmethod
+    def cell(lat, lon):
+        return math.floor(lat / LAT_LON_RANGE), math.floor(lon / LAT_LON_RANGE)
+
+    def add(self, city, lat, lon):
+        self.cells[self.cell(lat, lon)].append((city, lat, lon))
+
+    def has_duplicate(self, city, lat, lon):
+        #anything within range is in this cell or one of its 8 neighbours
+        row, col = self.cell(lat, lon)
+        for cell in ((row + dr, col + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)):
+            for other, other_lat, other_lon in self.cells.get(cell, ()):
+                if other == city and abs(other_lat - lat) <= LAT_LON_RANGE and abs(other_lon - lon) <= LAT_LON_RANGE:
+                    return True
+        return False
+
+
+def place(row):
+    """(city, state, country code) of an upload row, as the geocoder takes it."""
+    return row["city_name"], row["state_code"] or None, row["country_code"]
+
+
+def import_rows(db_path, rows, chunk_size=500, start_line=1, on_chunk=None, geocode=None):
+    """
+    Validate upload rows and insert the new cities in chunked transactions.
+
+    rows can be any iterable (e.g. a csv reader over the upload stream); it
+    is consumed chunk_size rows at a time, so memory stays flat however big
+    the file is. start_line is the file line just before the first row (1
+    for the header). on_chunk(conn, rows, success, warn, fail, records) is
+    called with each chunk's counts and its (line, level, message) log
+    records inside the chunk's transaction, so progress and logs written
+    there are committed atomically with the inserts. Without on_chunk the
+    records go to the logging module. With geocode (a function taking a list
+    of places and returning {place: geo or None}), rows may leave lat/lon
+    blank; each chunk's missing coordinates are resolved in one batch.
+
+    Each row is checked for duplicates with an R*Tree window query against
+    the cities table and a grid lookup against rows earlier in the same
+    upload. Each chunk is inserted with executemany inside a single
+    transaction and only then logged, so the log lines and counters match
+    the row-by-row import. Returns (successful rows, warning rows, failed
+    rows). Needs the indexes from create_city_indexes.
+    """
+    total_row_success = 0
+    total_row_warn = 0
+    total_row_errors = 0
+
+    #set line variable to excel row where data starts for error logging through upload file
+    line = start_line
+
+    accepted = UploadGrid()
+
+    rows = iter(rows)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            records = []
+            inserts = []
+            chunk_success = total_row_success
+            chunk_warn = total_row_warn
+            chunk_errors = total_row_errors
+
+            #validate the whole chunk at once and normalize the fields used for the duplicate check
+            checked = []
+            for row, errors in zip(chunk, validate_rows(chunk, geocode is not None)):
+                line += 1
+                city = None
+                if not errors:
+                    city = (row["city_name"].title(), row["country_code"], row["country (2 letter)"].upper())
+                checked.append((line, row, errors, city))
+
+            #geocode the valid rows without coordinates in one batch
+            places = [place(row) for line, row, errors, city in checked if city is not None and not row["lat"]]
+            found = geocode(places) if places else {}
+
+            for line, row, errors, city in checked:
+                #log current line in excel file
+                records.append((line, logging.INFO, f"Processing line {line} of upload file"))
+                records.extend((line, logging.ERROR, error) for error in errors)
+
+                if errors:
+                    records.append((line, logging.WARNING, f"{len(errors)} error(s) found in line {line}"))
+                    total_row_errors += 1
+                    continue
+
+                cityname, country_code, country = city
+                if row["lat"]:
+                    lat = float(row["lat"])
+                    lon = float(row["lon"])
+                else:
+                    geo = found.get(place(row))
+                    if geo is None:
+                        records.append((line, logging.ERROR, f"{cityname}, {country} could not be geocoded. Please enter lat and lon for this city"))
+                        records.append((line, logging.WARNING, f"1 error(s) found in line {line}"))
+                        total_row_errors += 1
+                        continue
+                    lat = geo["lat"]
+                    lon = geo["lon"]
+
+                #if already exists in db (or earlier in this file) log warning and don't submit to db
+                if accepted.has_duplicate(city, lat, lon) or in_database(conn, city, lat, lon):
+                    records.append((line, logging.WARNING, f"{cityname}, {country} already exists in the database! This line will not submit to database."))
+                    records.append((line, logging.INFO, f"1 warning found in line {line}"))
+                    total_row_warn += 1
+                    continue
+
+                state_code = row["state_code"] if row["state_code"] else None
+                inserts.append((cityname, state_code, country_code, lat, lon, country))
+                accepted.add(city, lat, lon)
+                records.append((line, logging.INFO, f"{cityname}, {country} entered into DB successfully"))
+                records.append((line, logging.INFO, f"No errors or warnings found in line {line}"))
+                total_row_success += 1
+
+            #one transaction per chunk
+            with conn:
+                conn.executemany("INSERT INTO cities (city_name, state_code, country_code, lat, lon, country) VALUES (?, ?, ?, ?, ?, ?)", inserts)
+                if on_chunk is not None:
+                    on_chunk(conn, len(chunk), total_row_success - chunk_success, total_row_warn - chunk_warn,
+                             total_row_errors - chunk_errors, records)
+
+            if on_chunk is None:
+                for line, level, message in records:
+                    logging.log(level, message)
+    finally:
+        conn.close()
+
+    return total_row_success, total_row_warn, total_row_errors
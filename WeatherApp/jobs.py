@@ -0,0 +1,302 @@
+import csv
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class JobTakenOver(Exception):
+    """Raised when a job's chunk would commit after another worker took the job over."""
+
+
+class ImportJobs:
+    """
+    Background queue for file upload imports, persisted in the import_jobs table.
+
+    An upload is spooled to spool_folder and recorded as a queued job, and a
+    small pool of threads claims queued jobs and runs them with run_job. Job
+    rows carry progress counters (updated in the same transaction as each
+    chunk of inserted cities, see progress) and a heartbeat, kept fresh by a
+    thread while the job runs, so a job whose worker died is picked up again
+    after stale_after seconds and resumes after the last committed chunk.
+    Every claim gets a new owner token and chunks only commit while their
+    worker still owns the job, so a worker that was merely slow can't insert
+    rows the new owner inserts too. Each job's log lines go to the
+    import_log table in the same transactions, and report streams them back
+    as text or csv. Claims are atomic, so several processes can share one
+    queue: the threads run in web workers (start) or in a process of their
+    own (serve). A job's spool file is deleted once it ends, and idle threads
+    sweep finished jobs older than keep_days, with their logs, at most once
+    per sweep_interval.
+    """
+
+    def __init__(self, db_path, spool_folder, run_job, workers=2, stale_after=120, keep_days=30, poll_interval=2, sweep_interval=3600):
+        self.db_path = db_path
+        self.spool_folder = spool_folder
+        self.run_job = run_job
+        self.workers = workers
+        self.stale_after = stale_after
+        self.keep_days = keep_days
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self._swept_at = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+        os.makedirs(spool_folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS import_jobs (
+                                job_id TEXT PRIMARY KEY NOT NULL,
+                                user_id INTEGER NOT NULL,
+                                filename TEXT NOT NULL,
+                                path TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                rows_done INTEGER NOT NULL DEFAULT 0,
+                                success INTEGER NOT NULL DEFAULT 0,
+                                warn INTEGER NOT NULL DEFAULT 0,
+                                fail INTEGER NOT NULL DEFAULT 0,
+                                created_at REAL NOT NULL,
+                                started_at REAL,
+                                heartbeat REAL,
+                                finished_at REAL,
+                                error TEXT,
+                                owner TEXT)""")
+            #tables created before owner tokens existed
+            if "owner" not in [column["name"] for column in conn.execute("PRAGMA table_info(import_jobs)")]:
+                conn.execute("ALTER TABLE import_jobs ADD COLUMN owner TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS import_jobs_status ON import_jobs (status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS import_jobs_user ON import_jobs (user_id, created_at)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS import_log (
+                                job_id TEXT NOT NULL,
+                                seq INTEGER NOT NULL,
+                                line INTEGER,
+                                level TEXT NOT NULL,
+                                message TEXT NOT NULL,
+                                created_at REAL NOT NULL,
+                                PRIMARY KEY (job_id, seq)) WITHOUT ROWID""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        """Start the job threads once per process (safe to call on every request, and after a fork)."""
+        if len(self._threads) == self.workers and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="import-job", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def serve(self):
+        """Run the job threads until interrupted, for a process that does nothing else (flask --app app import-worker)."""
+        self.start()
+        for thread in self._threads:
+            thread.join()
+
+    def create(self, user_id, filename, stream):
+        """Spool an uploaded stream to disk and queue it. Returns the job id."""
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.spool_folder, f"{job_id}.csv")
+
+        with open(path, "wb") as f:
+            while True:
+                block = stream.read(1024 * 1024)
+                if not block:
+                    break
+                f.write(block)
+
+        with self._connect() as conn:
+            conn.execute("INSERT INTO import_jobs (job_id, user_id, filename, path, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                         (job_id, user_id, filename, path, time.time()))
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        """Job row as a dict with elapsed seconds and rows/sec added, or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM import_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        job = dict(row)
+        if job["started_at"]:
+            elapsed = (job["finished_at"] or time.time()) - job["started_at"]
+            job["elapsed"] = round(elapsed, 2)
+            job["rows_per_sec"] = round(job["rows_done"] / elapsed, 1) if elapsed > 0 else 0
+        return job
+
+    def latest(self, user_id):
+        """The user's most recent job, or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT job_id FROM import_jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
+                               (user_id,)).fetchone()
+        return self.get(row["job_id"]) if row is not None else None
+
+    def progress(self, conn, job, rows, success, warn, fail, records=()):
+        """
+        Add a committed chunk's counts and log records to the claimed job. Call inside the chunk's transaction on conn.
+
+        Raises JobTakenOver (rolling the chunk back) if another worker owns the job by now.
+        """
+        owned = conn.execute("""UPDATE import_jobs SET rows_done = rows_done + ?, success = success + ?, warn = warn + ?,
+                                fail = fail + ?, heartbeat = ? WHERE job_id = ? AND owner = ?""",
+                             (rows, success, warn, fail, time.time(), job["job_id"], job["owner"])).rowcount
+        if not owned:
+            raise JobTakenOver(job["job_id"])
+        self.log(conn, job["job_id"], records)
+
+    def log(self, conn, job_id, records):
+        """Append (line, level, message) records to the job's log with one executemany."""
+        if not records:
+            return
+        now = time.time()
+        start = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM import_log WHERE job_id = ?", (job_id,)).fetchone()[0]
+        conn.executemany("INSERT INTO import_log (job_id, seq, line, level, message, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         ((job_id, start + i, line, logging.getLevelName(level), message, now)
+                          for i, (line, level, message) in enumerate(records, 1)))
+
+    def log_now(self, job_id, records):
+        """Append log records in a transaction of their own."""
+        with self._connect() as conn:
+            self.log(conn, job_id, records)
+
+    def report(self, job_id, fmt="txt", batch=1000):
+        """
+        Stream a job's log as text (in the old log.txt layout) or csv, a batch of rows at a time.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute("SELECT line, level, message, created_at FROM import_log WHERE job_id = ? ORDER BY seq", (job_id,))
+
+            out = io.StringIO()
+            writer = csv.writer(out)
+            if fmt == "csv":
+                writer.writerow(["time", "line", "level", "message"])
+
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    #same timestamp layout as logging's asctime
+                    created = row["created_at"]
+                    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)) + f",{int(created * 1000) % 1000:03d}"
+                    if fmt == "csv":
+                        writer.writerow([stamp, row["line"], row["level"], row["message"]])
+                    else:
+                        out.write(f"{stamp} {row['level']:<8} {row['message']}\n")
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+        finally:
+            conn.close()
+
+    def _claim(self):
+        """Take the oldest queued job, or one whose worker stopped sending heartbeats."""
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""SELECT * FROM import_jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?)
+                                  ORDER BY created_at LIMIT 1""", (now - self.stale_after,)).fetchone()
+            job = None
+            if row is not None:
+                job = dict(row, owner=uuid.uuid4().hex)
+                conn.execute("""UPDATE import_jobs SET status = 'running', started_at = COALESCE(started_at, ?), heartbeat = ?, owner = ?
+                                WHERE job_id = ?""", (now, now, job["owner"], job["job_id"]))
+            conn.execute("COMMIT")
+            return job
+        finally:
+            conn.close()
+
+    def _beat(self, job, stop):
+        """Refresh the job's heartbeat until stop is set or the job is no longer ours (chunks can take longer than stale_after)."""
+        while not stop.wait(self.stale_after / 4):
+            try:
+                with self._connect() as conn:
+                    owned = conn.execute("UPDATE import_jobs SET heartbeat = ? WHERE job_id = ? AND owner = ?",
+                                         (time.time(), job["job_id"], job["owner"])).rowcount
+                if not owned:
+                    return
+            except sqlite3.Error:
+                logging.getLogger(__name__).exception("import job heartbeat failed")
+
+    def _finish(self, job, status, error=None):
+        """Record how the job ended and delete its spool file, unless another worker owns it by now. Returns whether it did."""
+        with self._connect() as conn:
+            finished = conn.execute("UPDATE import_jobs SET status = ?, finished_at = ?, error = ? WHERE job_id = ? AND owner = ?",
+                                    (status, time.time(), error, job["job_id"], job["owner"])).rowcount > 0
+        if finished and os.path.exists(job["path"]):
+            os.remove(job["path"])
+        return finished
+
+    def sweep(self, now=None):
+        """
+        Delete finished jobs older than keep_days with their logs, and spool files no job owns, if the last sweep in this
+        process is more than sweep_interval ago.
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            if now - self._swept_at < self.sweep_interval:
+                return
+            self._swept_at = now
+
+        with self._connect() as conn:
+            old = conn.execute("SELECT job_id, path FROM import_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                               (now - self.keep_days * 86400,)).fetchall()
+        for row in old:
+            #a transaction per job, so a long log doesn't hold the write lock for the whole sweep
+            with self._connect() as conn:
+                conn.execute("DELETE FROM import_log WHERE job_id = ?", (row["job_id"],))
+                conn.execute("DELETE FROM import_jobs WHERE job_id = ?", (row["job_id"],))
+            if os.path.exists(row["path"]):
+                os.remove(row["path"])
+
+        #uploads spooled by a worker that died before queueing them (files still being written are recent)
+        for name in os.listdir(self.spool_folder):
+            path = os.path.join(self.spool_folder, name)
+            if not name.endswith(".csv") or os.path.getmtime(path) > now - self.stale_after:
+                continue
+            with self._connect() as conn:
+                known = conn.execute("SELECT 1 FROM import_jobs WHERE job_id = ?", (name[:-len(".csv")],)).fetchone()
+            if known is None:
+                os.remove(path)
+
+    def _run(self):
+        while True:
+            job = None
+            try:
+                job = self._claim()
+                if job is None:
+                    self.sweep()
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+                    continue
+
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self._beat, args=(job, stop), name="import-job-heartbeat", daemon=True)
+                heartbeat.start()
+                try:
+                    self.run_job(job)
+                finally:
+                    stop.set()
+                self._finish(job, "done")
+
+            except JobTakenOver:
+                #the new owner resumes after the last chunk this worker committed
+                logging.getLogger(__name__).warning("import job %s was taken over by another worker", job["job_id"])
+
+            except Exception as e:
+                logging.getLogger(__name__).exception("import job failed")
+                if job is not None:
+                    self._finish(job, "failed", str(e))
+                time.sleep(self.poll_interval)
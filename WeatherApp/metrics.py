@@ -0,0 +1,309 @@
+import bisect
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from cache import shared_connection
+
+
+#histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def series_order(entry):
+    """Sort key grouping a histogram's series by label set, buckets in ascending le."""
+    name, labels, value = entry
+    others = json.dumps({key: value for key, value in labels.items() if key != "le"}, sort_keys=True)
+    return others, name, float(labels.get("le", 0))
+
+
+class Metrics:
+    """
+    Counters and histograms that add up across workers.
+
+    Each process keeps its own totals in memory (cheap enough for every
+    query and request) and writes them to a SQLite file as rows of its own
+    every flush_interval seconds. Histograms are stored as their _bucket,
+    _sum and _count series, so every row is a plain counter and render()
+    just sums them per series over all workers, including workers that have
+    since exited, so totals never go backwards. Rows of workers that haven't
+    flushed for retire_after seconds are folded into one retired row, so the
+    file doesn't grow with every worker restart.
+    """
+
+    RETIRED = "retired"
+
+    def __init__(self, path, flush_interval=5, buckets=DEFAULT_BUCKETS, retire_after=600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.retire_after = retire_after
+        self._values = defaultdict(float)
+        #encoded (name, labels) keys per series, so hot paths don't run json.dumps on every call
+        self._counter_keys = {}
+        self._histogram_keys = {}
+        self._flushed = {}
+        self._flush_lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._worker = None
+
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS metric_values (
+                            worker TEXT NOT NULL,
+                            name TEXT NOT NULL,
+                            labels TEXT NOT NULL,
+                            value REAL NOT NULL,
+                            updated_at REAL NOT NULL,
+                            PRIMARY KEY (worker, name, labels)) WITHOUT ROWID""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS metric_types (
+                            name TEXT PRIMARY KEY NOT NULL,
+                            type TEXT NOT NULL,
+                            help TEXT NOT NULL)""")
+
+    def _connect(self):
+        return shared_connection(self._local, self.path)
+
+    def _check_fork(self):
+        #a forked worker starts its own series instead of overwriting its parent's
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._worker = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+                    self._values.clear()
+                    self._flushed = {}
+                    self._local = threading.local()
+
+    def describe(self, name, kind, help_text):
+        """Declare a metric's type (counter or histogram) and help text."""
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    def inc(self, name, labels=None, amount=1):
+        self._check_fork()
+        labels = labels or {}
+        series = (name, tuple(sorted(labels.items())))
+        key = self._counter_keys.get(series)
+        if key is None:
+            key = self._counter_keys[series] = (name, json.dumps(labels, sort_keys=True))
+        with self._lock:
+            self._values[key] += amount
+
+    def _histogram_series(self, name, labels):
+        """([_bucket keys in bucket order, +Inf last], _sum key, _count key) for a histogram's label set."""
+        series = (name, tuple(sorted(labels.items())))
+        keys = self._histogram_keys.get(series)
+        if keys is None:
+            buckets = [(name + "_bucket", json.dumps(dict(labels, le=str(bound)), sort_keys=True)) for bound in self.buckets]
+            buckets.append((name + "_bucket", json.dumps(dict(labels, le="+Inf"), sort_keys=True)))
+            encoded = json.dumps(labels, sort_keys=True)
+            keys = self._histogram_keys[series] = (buckets, (name + "_sum", encoded), (name + "_count", encoded))
+        return keys
+
+    def observe(self, name, seconds, labels=None):
+        self._check_fork()
+        buckets, sum_key, count_key = self._histogram_series(name, labels or {})
+        #buckets are cumulative: every bound at or above seconds, and +Inf
+        first = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            for key in buckets[first:]:
+                self._values[key] += 1
+            self._values[sum_key] += seconds
+            self._values[count_key] += 1
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time the block into histogram name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    def start(self):
+        """Start the flush thread once per process (safe to call on every request, and after a fork)."""
+        self._check_fork()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """Write this worker's totals and metric types to the shared file, and retire workers that stopped flushing."""
+        self._check_fork()
+        now = time.time()
+
+        conn = self._connect()
+        with self._flush_lock:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if self._flushed and conn.execute("SELECT 1 FROM metric_values WHERE worker = ? LIMIT 1", (self._worker,)).fetchone() is None:
+                    #this worker stalled long enough to be retired, what it flushed last is in the retired row already
+                    with self._lock:
+                        for key, value in self._flushed.items():
+                            self._values[key] -= value
+                        self._worker = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+
+                with self._lock:
+                    values = dict(self._values)
+                    worker = self._worker
+                conn.executemany("INSERT OR REPLACE INTO metric_values (worker, name, labels, value, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                 [(worker, name, labels, value, now) for (name, labels), value in values.items()])
+                conn.executemany("INSERT OR REPLACE INTO metric_types (name, type, help) VALUES (?, ?, ?)",
+                                 [(name, kind, self._help[name]) for name, kind in self._types.items()])
+
+                #fold exited workers into the retired row, render() sums the same either way
+                cutoff = now - self.retire_after
+                conn.execute("""INSERT INTO metric_values (worker, name, labels, value, updated_at)
+                                SELECT ?, name, labels, SUM(value), ? FROM metric_values WHERE worker != ? AND updated_at < ?
+                                GROUP BY name, labels
+                                ON CONFLICT (worker, name, labels) DO UPDATE SET value = value + excluded.value, updated_at = excluded.updated_at""",
+                             (self.RETIRED, now, self.RETIRED, cutoff))
+                conn.execute("DELETE FROM metric_values WHERE worker != ? AND updated_at < ?", (self.RETIRED, cutoff))
+            self._flushed = values
+
+    def render(self, gauges=()):
+        """
+        Prometheus text exposition of every worker's totals, plus gauges
+        given as (name, help, [(labels, value)]) computed by the caller.
+        """
+        self.flush()
+        conn = self._connect()
+        types = {name: (kind, help_text) for name, kind, help_text in conn.execute("SELECT name, type, help FROM metric_types")}
+        rows = conn.execute("SELECT name, labels, SUM(value) FROM metric_values GROUP BY name, labels ORDER BY name, labels").fetchall()
+
+        series = defaultdict(list)
+        for name, labels, value in rows:
+            base = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and name[:-len(suffix)] in types:
+                    base = name[:-len(suffix)]
+            series[base].append((name, json.loads(labels), value))
+
+        lines = []
+        for base in sorted(series):
+            kind, help_text = types.get(base, ("untyped", ""))
+            lines.append(f"# HELP {base} {help_text}")
+            lines.append(f"# TYPE {base} {kind}")
+            entries = sorted(series[base], key=series_order)
+            for name, labels, value in entries:
+                lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+        for name, help_text, values in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                #metrics must never take the app down, the next flush retries
+                pass
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for the slowest requests.
+
+    While enabled, a thread samples the stack of every thread that is
+    serving a request every interval seconds. When a request finishes after
+    more than threshold seconds its folded stacks (flame graph format, one
+    "frame;frame;frame count" line per stack) are kept if it is among the
+    keep slowest seen so far. Requests in other workers are profiled by
+    their own worker.
+    """
+
+    def __init__(self, interval=0.01, threshold=0.5, keep=10):
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+        self._active = {}
+        self._slowest = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+
+    def begin(self, description):
+        with self._lock:
+            self._active[threading.get_ident()] = (description, time.perf_counter(), Counter())
+
+    def end(self):
+        with self._lock:
+            entry = self._active.pop(threading.get_ident(), None)
+        if entry is None:
+            return
+
+        description, started, stacks = entry
+        elapsed = time.perf_counter() - started
+        if elapsed < self.threshold:
+            return
+
+        with self._lock:
+            record = (elapsed, time.time(), description, dict(stacks))
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, record)
+            elif elapsed > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, record)
+
+    def dump(self):
+        """Text report of the slowest requests kept, slowest first."""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+
+        lines = []
+        for elapsed, finished, description, stacks in slowest:
+            lines.append(f"# {description} took {elapsed * 1000:.1f} ms at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(finished))}")
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                lines.append(f"{stack} {count}")
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, (description, started, stacks) in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = ";".join(f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+                                         for entry in traceback.extract_stack(frame))
+                        stacks[stack] += 1
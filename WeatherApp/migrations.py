@@ -0,0 +1,73 @@
+import sqlite3
+
+from citysearch import create_city_search
+from importer import create_city_indexes
+
+
+def dashboard_constraints(conn):
+    """
+    Rebuild dashboard with UNIQUE (user_id, city_id) and cascading deletes.
+
+    The unique index also serves every lookup by user_id, and
+    dashboard_city covers lookups and cascades by city. Duplicate rows
+    (left by the old check-then-insert) and rows pointing at deleted users
+    or cities are dropped on the way.
+    """
+    conn.execute("""CREATE TABLE dashboard_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        city_id INTEGER NOT NULL,
+                        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+                        FOREIGN KEY(city_id) REFERENCES cities(city_id) ON DELETE CASCADE,
+                        UNIQUE (user_id, city_id))""")
+    conn.execute("""INSERT INTO dashboard_new (id, user_id, city_id)
+                    SELECT MIN(id), user_id, city_id FROM dashboard
+                    WHERE user_id IN (SELECT id FROM users) AND city_id IN (SELECT city_id FROM cities)
+                    GROUP BY user_id, city_id""")
+    conn.execute("DROP TABLE dashboard")
+    conn.execute("ALTER TABLE dashboard_new RENAME TO dashboard")
+    conn.execute("CREATE INDEX dashboard_city ON dashboard (city_id)")
+
+
+#applied in order, PRAGMA user_version is the number already applied
+MIGRATIONS = [
+    create_city_indexes,
+    dashboard_constraints,
+    create_city_search,
+]
+
+
+def migrate(db_path, migrations=MIGRATIONS):
+    """
+    Apply the migrations weather.db hasn't had yet. Returns the schema version.
+
+    Each migration runs in its own immediate transaction together with the
+    user_version bump, so a failed migration leaves the previous version in
+    place, and workers starting at the same time apply each one only once.
+    Foreign keys are off while migrating (tables get rebuilt) and checked
+    before each commit.
+    """
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        conn.execute("PRAGMA foreign_keys=OFF")
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(migrations):
+                    conn.execute("COMMIT")
+                    return version
+
+                migrations[version](conn)
+
+                problems = conn.execute("PRAGMA foreign_key_check").fetchall()
+                if problems:
+                    raise sqlite3.IntegrityError(f"migration {version + 1} broke foreign keys: {problems[:5]}")
+
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
@@ -0,0 +1,167 @@
+import threading
+import time
+
+from collections import deque
+
+from cache import shared_connection
+
+
+class SharedTokenBucket:
+    """
+    Token bucket shared by every worker through a SQLite file.
+
+    The bucket refills at requests_per_minute and holds at most burst tokens.
+    Its state is one row updated inside an immediate transaction, so all
+    workers draw from the same budget.
+    """
+
+    def __init__(self, path, name, requests_per_minute, burst=10):
+        self.path = path
+        self.name = name
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS rate_buckets (
+                            name TEXT PRIMARY KEY NOT NULL,
+                            tokens REAL NOT NULL,
+                            updated_at REAL NOT NULL)""")
+        conn.execute("INSERT OR IGNORE INTO rate_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                     (name, float(burst), time.time()))
+
+    def _connect(self):
+        return shared_connection(self._local, self.path)
+
+    def try_take(self):
+        """Take a token if one is available. Returns (taken, seconds until the next token)."""
+        conn = self._connect()
+        now = time.time()
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            tokens, updated_at = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE name = ?",
+                                              (self.name,)).fetchone()
+            tokens = min(self.capacity, tokens + max(now - updated_at, 0) * self.rate)
+            taken = tokens >= 1
+            if taken:
+                tokens -= 1
+            conn.execute("UPDATE rate_buckets SET tokens = ?, updated_at = ? WHERE name = ?", (tokens, now, self.name))
+
+        return taken, 0 if taken else (1 - tokens) / self.rate
+
+    def take(self, timeout=None):
+        """Block until a token is taken. Returns False if that would take longer than timeout seconds."""
+        give_up = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            taken, wait = self.try_take()
+            if taken:
+                return True
+            if give_up is not None:
+                if time.monotonic() + wait > give_up:
+                    return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream that keeps failing.
+
+    Outcomes of the last window seconds are tracked per process. Once at
+    least min_calls have been made and the failure ratio reaches threshold
+    (or the upstream answers 429), the breaker opens for cooldown seconds, or
+    for as long as Retry-After asks if that is longer. The open-until time is
+    written to the shared file so every worker fails fast together. After the
+    cool-down one trial call is let through; its outcome closes or reopens
+    the breaker, and a trial that ends without one is abandoned so the next
+    call can try. Only the call allow() picked as the trial reports or
+    abandons it.
+    """
+
+    def __init__(self, path, name, threshold=0.5, min_calls=10, window=60, cooldown=30):
+        self.path = path
+        self.name = name
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._outcomes = deque()
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS circuit_breakers (
+                            name TEXT PRIMARY KEY NOT NULL,
+                            open_until REAL NOT NULL)""")
+        conn.execute("INSERT OR IGNORE INTO circuit_breakers (name, open_until) VALUES (?, 0)", (name,))
+
+    def _connect(self):
+        return shared_connection(self._local, self.path)
+
+    def open_until(self):
+        row = self._connect().execute("SELECT open_until FROM circuit_breakers WHERE name = ?", (self.name,)).fetchone()
+        return row[0]
+
+    def is_open(self):
+        return self.open_until() > time.time()
+
+    def allow(self, open_until=None):
+        """
+        Whether a call may go out now, as (allowed, trial): trial is True for
+        the one call let through after a cool-down. Pass it on to record(),
+        or to abandon() if the call ends without an outcome. An open_until
+        already read (open_until()) skips the shared file, so a coroutine can
+        read it on a thread and claim the trial on its loop.
+        """
+        if open_until is None:
+            open_until = self.open_until()
+        if open_until > time.time():
+            return False, False
+
+        #just past a cool-down: only one trial call until it reports back
+        if open_until > 0:
+            with self._lock:
+                if self._trial_running:
+                    return False, False
+                self._trial_running = True
+            return True, True
+        return True, False
+
+    def abandon(self, trial):
+        """The call allow() let through ended without an outcome (e.g. it was cancelled): if it was the trial, the next call gets it."""
+        if trial:
+            with self._lock:
+                self._trial_running = False
+
+    def _open(self, seconds):
+        conn = self._connect()
+        conn.execute("UPDATE circuit_breakers SET open_until = MAX(open_until, ?) WHERE name = ?",
+                     (time.time() + seconds, self.name))
+        self._outcomes.clear()
+
+    def record(self, ok, retry_after=None, trial=False):
+        """Report the outcome of a call (trial as allow() returned it). retry_after (seconds) trips the breaker straight away."""
+        now = time.time()
+
+        with self._lock:
+            if trial:
+                self._trial_running = False
+                if ok:
+                    self._connect().execute("UPDATE circuit_breakers SET open_until = 0 WHERE name = ?", (self.name,))
+                else:
+                    self._open(max(self.cooldown, retry_after or 0))
+                return
+
+            if retry_after is not None:
+                self._open(max(self.cooldown, retry_after))
+                return
+
+            self._outcomes.append((now, ok))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+
+            failures = sum(1 for when, success in self._outcomes if not success)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.threshold:
+                self._open(self.cooldown)
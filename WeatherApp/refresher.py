@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import threading
+import time
+
+import helpers
+
+
+class WeatherRefresher:
+    """
+    Background thread that keeps the weather cache warm for dashboard cities.
+
+    Every tick it loads the distinct cities referenced by dashboards and
+    refreshes the ones whose cached reading is older than their interval:
+    cities on at least hot_subscribers dashboards use hot_interval, the rest
+    use cold_interval. Only one worker sweeps at a time (it holds a lease in
+    the shared cache), but any worker can queue urgent refreshes for stale
+    readings it just served. Both are fetched through bulk (a
+    bulkweather.BulkWeather), due cities batch_size at a time, so cities in
+    one grid cell share a call and dense areas are fetched with box calls.
+    The upstream client's shared rate limit paces every call, and nothing is
+    refreshed while its circuit breaker is open.
+    """
+
+    LEADER_KEY = ["weather-refresher"]
+
+    def __init__(self, load_cities, bulk, hot_interval=300, cold_interval=1800, hot_subscribers=2, batch_size=500, tick=5):
+        self.load_cities = load_cities
+        self.bulk = bulk
+        self.hot_interval = hot_interval
+        self.cold_interval = cold_interval
+        self.hot_subscribers = hot_subscribers
+        self.batch_size = batch_size
+        self.tick = tick
+        self._urgent = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._leader_until = 0
+        self._loop = None
+
+    def start(self):
+        """Start the refresher thread once per process (safe to call on every request, and after a fork)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="weather-refresher", daemon=True)
+                self._thread.start()
+
+    def request_refresh(self, rows):
+        """Queue rows (with lat and lon) for a refresh ahead of the regular sweep."""
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                self._urgent[(row["lat"], row["lon"])] = row
+        self._wake.set()
+
+    def interval_for(self, city):
+        if city["subscribers"] >= self.hot_subscribers:
+            return self.hot_interval
+        return self.cold_interval
+
+    def _is_leader(self):
+        """Hold (or take over) the sweep lease shared by all workers."""
+        cache = helpers.weather_cache
+        now = time.time()
+        lease_ttl = self.tick * 3
+
+        if self._leader_until > now:
+            cache.renew_lease(self.LEADER_KEY, lease_ttl)
+        elif not cache.acquire_lease(self.LEADER_KEY, lease_ttl):
+            return False
+
+        self._leader_until = now + lease_ttl
+        return True
+
+    def reading_age(self, city):
+        cached = helpers.weather_cache.peek(helpers.weather_cache_key(city["lat"], city["lon"]))
+        return float("inf") if cached is None else cached[1]
+
+    def due_cities(self):
+        """Cities whose reading is older than their interval, stalest first."""
+        due = []
+        for city in self.load_cities():
+            age = self.reading_age(city)
+            if age >= self.interval_for(city):
+                due.append((age, city))
+
+        due.sort(key=lambda pair: pair[0], reverse=True)
+        return [city for age, city in due]
+
+    def _drain_urgent(self):
+        with self._lock:
+            rows = list(self._urgent.values())
+            self._urgent.clear()
+        #skip rows the sweep (or an earlier drain) refreshed since they were queued
+        if helpers.weather_cache is not None:
+            rows = [row for row in rows if self.reading_age(row) >= helpers.weather_cache.ttl]
+        if rows:
+            self._loop.run_until_complete(self.bulk.refresh(rows))
+
+    def _run(self):
+        #one event loop for the life of the thread, so the async client's pooled connections are reused between batches
+        self._loop = asyncio.new_event_loop()
+        while True:
+            try:
+                #wait out the breaker's cool-down rather than queueing calls that would fail fast
+                if not helpers.upstream.available():
+                    time.sleep(self.tick)
+                    continue
+
+                self._drain_urgent()
+
+                if helpers.weather_cache is not None and self._is_leader():
+                    due = self.due_cities()
+                    for start in range(0, len(due), self.batch_size):
+                        #stop if another worker took the sweep over
+                        if not self._is_leader():
+                            break
+                        #skip cities an urgent refresh (or an earlier batch, for cities in the same cell) already covered
+                        batch = [city for city in due[start:start + self.batch_size]
+                                 if self.reading_age(city) >= self.interval_for(city)]
+                        self._loop.run_until_complete(self.bulk.refresh(batch))
+                        #urgent requests from the dashboard jump the queue
+                        self._drain_urgent()
+
+            except Exception:
+                logging.getLogger(__name__).exception("weather refresh failed")
+
+            self._wake.wait(self.tick)
+            self._wake.clear()
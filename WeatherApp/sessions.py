@@ -0,0 +1,136 @@
+import secrets
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+from cache import shared_connection
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class SQLiteSession(SecureCookieSession):
+    """Session dict that also knows its id and when its stored copy expires."""
+
+    def __init__(self, initial=None, sid=None, expires_at=0):
+        super().__init__(initial)
+        self.sid = sid or new_sid()
+        self.expires_at = expires_at
+        self.replaced_sid = None
+
+    def clear(self):
+        #login and logout clear the session, a new id means an id known before login is worthless after it
+        super().clear()
+        if self.replaced_sid is None and self.expires_at:
+            self.replaced_sid = self.sid
+        self.sid = new_sid()
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """
+    Server-side sessions in a SQLite file shared by every worker.
+
+    The cookie only carries a random session id; the data lives in one WAL
+    mode table with a memory-mapped read window, so opening a session is an
+    indexed point read and saving one is a single upsert instead of a pickle
+    file written per request. Requests that don't change the session write
+    nothing (an unchanged session's expiry is pushed back at most once per
+    half lifetime), and expired sessions are deleted in batches of
+    sweep_batch at most once per sweep_interval instead of on every request.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, path, sweep_interval=300, sweep_batch=1000, mmap_size_mb=64):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.mmap_size_mb = mmap_size_mb
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._swept_at = 0
+
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                            sid TEXT PRIMARY KEY NOT NULL,
+                            data TEXT NOT NULL,
+                            expires_at REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)")
+
+    def _connect(self):
+        fresh = getattr(self._local, "conn", None) is None
+        conn = shared_connection(self._local, self.path)
+        if fresh:
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size_mb) * 1024 * 1024}")
+        return conn
+
+    def _write(self, sql, args):
+        #threads of one worker queue here instead of in SQLite's busy handler, which backs off in sleeps of up to 100 ms
+        with self._write_lock:
+            self._connect().execute(sql, args)
+
+    def load(self, sid):
+        """Stored session for sid as (data, expires_at), or None if there is none or it expired."""
+        row = self._connect().execute("SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?",
+                                      (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return self.serializer.loads(row[0]), row[1]
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        stored = self.load(sid) if sid else None
+        if stored is not None:
+            return SQLiteSession(stored[0], sid, stored[1])
+
+        #unknown, expired or no cookie: a new id, only stored once something is put in the session
+        return SQLiteSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if session.replaced_sid is not None:
+            self._write("DELETE FROM sessions WHERE sid = ?", (session.replaced_sid,))
+
+        #cleared session (e.g. logout): drop the row and the cookie
+        if not session:
+            if session.modified:
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       partitioned=self.get_cookie_partitioned(app), samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        if session.modified:
+            self._write("""INSERT INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)
+                           ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at""",
+                        (session.sid, self.serializer.dumps(dict(session)), now + lifetime))
+        elif session.expires_at - now < lifetime / 2:
+            self._write("UPDATE sessions SET expires_at = ? WHERE sid = ?", (now + lifetime, session.sid))
+        elif not (session.permanent and app.config["SESSION_REFRESH_EACH_REQUEST"]):
+            #cookie already set and nothing changed, this request costs no write at all
+            self.sweep(now)
+            return
+
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            partitioned=self.get_cookie_partitioned(app), samesite=self.get_cookie_samesite(app))
+        self.sweep(now)
+
+    def sweep(self, now=None):
+        """Delete a batch of expired sessions if the last sweep in this worker is more than sweep_interval ago."""
+        now = now if now is not None else time.time()
+        if now - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = now
+        self._write("DELETE FROM sessions WHERE sid IN (SELECT sid FROM sessions WHERE expires_at <= ? LIMIT ?)",
+                    (now, self.sweep_batch))